@@ -0,0 +1,255 @@
+# This file is part of morss
+#
+# Copyright (C) 2013-2020 pictuga <contact@pictuga.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import copy
+import socket
+import ssl
+
+from .pool import PooledHTTPHandler, PooledHTTPSHandler
+from .responses import BodyResponse, SizeLimitHandler, parse_headers
+
+try:
+    # python 2
+    from httplib import HTTPException
+    from urllib2 import (HTTPError, HTTPErrorProcessor, HTTPHandler,
+                         HTTPRedirectHandler, HTTPSHandler, Request, URLError)
+    from urlparse import urlsplit
+except ImportError:
+    # python 3
+    from http.client import HTTPException
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlsplit
+    from urllib.request import (HTTPErrorProcessor, HTTPHandler,
+                                HTTPRedirectHandler, HTTPSHandler, Request)
+
+
+class RedirectCatcher:
+    " Stands in for the opener of a redirect handler, to get the new Request instead of opening it "
+
+    def open(self, req, timeout=None):
+        return req
+
+
+async def async_open(opener, url, data=None, timeout=None):
+    """ Equivalent of opener.open(url), running all the handlers of the opener,
+    except for the plain HTTP(S)Handler, replaced by async_http_open. The
+    handlers run in the default executor, as CacheHandler hits the cache
+    backend (e.g. redis or diskcache). `url` can also be a Request """
+
+    if isinstance(url, Request):
+        req = url
+
+        if data is not None:
+            req.data = data
+
+    else:
+        req = Request(url, data)
+
+    req.timeout = timeout
+    req.is_async = True # for CacheHandler not to wait on cache locks
+
+    limits = [x.limit for x in opener.handlers if isinstance(x, SizeLimitHandler)]
+    limit = min(limits) if limits else None
+
+    redirectors = [x for x in opener.handlers if isinstance(x, HTTPRedirectHandler)]
+
+    loop = asyncio.get_event_loop()
+
+    def process_request(req):
+        # (1) *_request
+        for processor in opener.process_request.get(req.type, []):
+            req = getattr(processor, req.type + '_request')(req)
+
+        return req
+
+    def handle_open(req):
+        # (2) *_open, the network part being ours (i.e. None returned)
+        for handler in opener.handle_open.get(req.type, []):
+            if isinstance(handler, (HTTPHandler, HTTPSHandler)):
+                continue
+
+            resp = getattr(handler, req.type + '_open')(req)
+
+            if resp is not None:
+                return resp
+
+        return None
+
+    def process_response(req, resp):
+        # (3) *_response, with HTTPErrorProcessor being replaced by what follows
+        for processor in opener.process_response.get(req.type, []):
+            if isinstance(processor, HTTPErrorProcessor):
+                continue
+
+            resp = getattr(processor, req.type + '_response')(req, resp)
+
+        return resp
+
+    while True:
+        req = await loop.run_in_executor(None, process_request, req)
+        resp = await loop.run_in_executor(None, handle_open, req)
+
+        if resp is None:
+            resp = await async_http_open(req, limit)
+
+        resp = await loop.run_in_executor(None, process_response, req, resp)
+
+        if 200 <= resp.code < 300:
+            return resp
+
+        # redirects
+        new = None
+
+        for redirector in redirectors:
+            redirector = copy.copy(redirector)
+            redirector.parent = RedirectCatcher()
+            method = getattr(redirector, 'http_error_%s' % resp.code, None)
+
+            if method is not None:
+                new = method(req, resp, resp.code, resp.msg, resp.headers)
+
+            if new is not None:
+                break
+
+        if new is None:
+            raise HTTPError(req.full_url, resp.code, resp.msg, resp.headers, resp)
+
+        new.timeout = req.timeout
+        new.is_async = True
+        req = new
+
+
+async def async_http_open(req, limit=None):
+    " Bare-bones HTTP/1.1 client on asyncio streams, returns a urllib-like response "
+
+    if getattr(req, '_tunnel_host', None):
+        # proxy tunnels aren't supported, leave it to urllib (in a thread)
+        handler = PooledHTTPSHandler() if req.type == 'https' else PooledHTTPHandler()
+        return await asyncio.get_event_loop().run_in_executor(None, getattr(handler, req.type + '_open'), req)
+
+    timeout = None if req.timeout is socket._GLOBAL_DEFAULT_TIMEOUT else req.timeout
+
+    try:
+        return await asyncio.wait_for(async_http_exchange(req, limit), timeout)
+
+    except asyncio.TimeoutError:
+        raise URLError(socket.timeout('timed out'))
+
+    except (OSError, HTTPException) as err:
+        raise URLError(err)
+
+
+async def async_http_exchange(req, limit=None):
+    parts = urlsplit('//' + req.host)
+
+    if req.type == 'https':
+        ssl_context = ssl._create_default_https_context()
+        port = parts.port or 443
+
+    else:
+        ssl_context = None
+        port = parts.port or 80
+
+    reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=ssl_context)
+
+    try:
+        # request
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers['Connection'] = 'close'
+
+        lines = ['%s %s HTTP/1.1' % (req.get_method(), req.selector)]
+        lines += ['%s: %s' % (name.title(), val) for name, val in headers.items()]
+
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1'))
+
+        if req.data is not None:
+            writer.write(req.data)
+
+        await writer.drain()
+
+        # status line & headers, skipping "100 Continue"
+        code = 100
+
+        while 100 <= code < 200:
+            status = (await reader.readline()).decode('iso-8859-1')
+
+            try:
+                version, code, reason = (status.rstrip('\r\n').split(None, 2) + [''])[:3]
+                code = int(code)
+
+            except ValueError:
+                raise HTTPException('bad status line: %r' % status)
+
+            raw_headers = []
+
+            while True:
+                line = await reader.readline()
+
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+                raw_headers.append(line.decode('iso-8859-1'))
+
+        headers = parse_headers(''.join(raw_headers) + '\n')
+
+        # body
+        if req.get_method() == 'HEAD' or code in (204, 304):
+            data = b''
+
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            data = b''
+
+            while limit is None or len(data) < limit:
+                size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+
+                if size == 0:
+                    break
+
+                data += await reader.readexactly(size)
+                await reader.readline()
+
+            del headers['transfer-encoding']
+
+        elif headers.get('content-length', '').isdigit():
+            size = int(headers['content-length'])
+
+            try:
+                data = await reader.readexactly(size if limit is None else min(size, limit))
+
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+
+        else:
+            data = b''
+
+            while limit is None or len(data) < limit:
+                chunk = await reader.read(64*1024)
+
+                if not chunk:
+                    break
+
+                data += chunk
+
+    finally:
+        writer.close()
+
+    if limit is not None:
+        data = data[:limit]
+
+    return BodyResponse(data, headers, req.get_full_url(), code, reason)
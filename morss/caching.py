@@ -15,29 +15,70 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import atexit
 import os
+import sys
 import threading
 import time
 from collections import OrderedDict
+from itertools import islice
+from contextlib import contextmanager, nullcontext
 
-CACHE_SIZE = int(os.getenv('CACHE_SIZE', 1000)) # max number of items in cache (default: 1k items)
+CACHE_MAX_ITEMS = int(os.getenv('CACHE_MAX_ITEMS', 0)) # max number of items in cache (0: backend's default, -1: no limit)
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 0)) # max size of the cache in Bytes (0: backend's default, -1: no limit)
+CACHE_SIZE = int(os.getenv('CACHE_SIZE', 0)) # legacy, items (or Bytes with diskcache), if the above aren't set
+DISKCACHE_SHARDS = int(os.getenv('DISKCACHE_SHARDS', 1)) # split diskcache in several databases, for less lock contention
 CACHE_LIFESPAN = int(os.getenv('CACHE_LIFESPAN', 60)) # how often to auto-clear the cache (default: 1min)
+CACHE_TTL = int(os.getenv('CACHE_TTL', 24*60*60)) # min time to keep items, on backends with expiry (default: 1 day)
+CACHE_L1_TTL = int(os.getenv('CACHE_L1_TTL', 0)) # how long to keep redis/diskcache items in memory too (0: disabled)
+CACHE_L1_BYTES = int(os.getenv('CACHE_L1_BYTES', 16*1024**2)) # max size of this in-memory copy (default: 16MiB)
+CACHE_LOCK = int(os.getenv('CACHE_LOCK', 0)) # max time to wait for another process fetching the same url (0: disabled)
 
 
 class BaseCache:
     """ Subclasses must behave like a dict """
 
-    def trim(self):
+    def trim(self, deadline=None):
+        """ Evicts expired/extra items. Should stop once `time.time()` gets past
+        `deadline` (to carry on at the next call) """
         pass
 
     def autotrim(self, delay=CACHE_LIFESPAN):
-        # trim the cache every so often
+        # trim the cache every so often, from the shared maintenance thread
+        maintenance.register(self, delay)
 
-        self.trim()
+    def set(self, key, data, ttl=None):
+        " Same as `cache[key] = data`, with `ttl` (in sec), if supported "
+        self[key] = data
 
-        t = threading.Timer(delay, self.autotrim)
-        t.daemon = True
-        t.start()
+    def get_many(self, keys):
+        " Returns {key: data} for the `keys` found in cache "
+
+        out = {}
+
+        for key in keys:
+            try:
+                out[key] = self[key]
+
+            except KeyError:
+                pass
+
+        return out
+
+    def stats(self):
+        " Usage statistics, if available "
+        return {}
+
+    def is_local(self, key):
+        " Whether reading `key` is answered from memory (vs. the backend) "
+        return False
+
+    def lock(self, key, timeout):
+        """ Context manager, held while fetching `key`, for other processes
+        to wait for it. Expires after `timeout` (in sec). Once acquired, reads
+        of `key` must reflect the shared backend. No-op by default """
+
+        return nullcontext()
 
     def __contains__(self, url):
         try:
@@ -50,17 +91,282 @@ class BaseCache:
             return True
 
 
-class CappedDict(OrderedDict, BaseCache):
-    def trim(self):
-        if CACHE_SIZE >= 0:
-            for i in range( max( len(self) - CACHE_SIZE , 0 )):
-                self.popitem(False)
+class CacheMaintenance:
+    """ Single background thread trimming the caches registered with autotrim,
+    each getting a time slice per pass """
+
+    slice = 0.5 # max time spent on a cache per pass (in sec)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.caches = {} # id -> [cache, delay, next run]
+        self.thread = None
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.passes = 0
+        self.last_duration = None # of the last pass (in sec)
+
+    def register(self, cache, delay=CACHE_LIFESPAN):
+        with self.lock:
+            self.caches[id(cache)] = [cache, delay, time.time()]
+
+        self.wakeup.set()
+        self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None and self.caches:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name='morss-cache-maintenance')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while not self.stopping.is_set():
+            with self.lock:
+                todo = [x for x in self.caches.values() if x[2] <= time.time()]
+                next_run = min([x[2] for x in self.caches.values()] or [time.time() + CACHE_LIFESPAN])
+
+            if todo:
+                start = time.time()
+
+                for entry in todo:
+                    try:
+                        entry[0].trim(deadline=time.time() + self.slice)
+
+                    except Exception:
+                        # e.g. backend not reachable, better luck next time
+                        pass
+
+                    with self.lock:
+                        entry[2] = time.time() + entry[1]
+
+                self.passes += 1
+                self.last_duration = time.time() - start
+
+            else:
+                self.wakeup.wait(max(next_run - time.time(), 0))
+                self.wakeup.clear()
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        self.wakeup.set()
+        thread = self.thread
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+        self.thread = None
+
+    def forget(self):
+        # after fork: the thread doesn't exist in the child, start a new one
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.start()
+
+    def stats(self):
+        with self.lock:
+            caches = [x[0] for x in self.caches.values()]
+
+        return {'passes': self.passes, 'last_duration': self.last_duration,
+            'caches': [cache.stats() for cache in caches]}
+
+
+maintenance = CacheMaintenance()
+atexit.register(maintenance.stop)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=maintenance.forget)
+
+
+class CappedDict(BaseCache):
+    """ In-memory LRU cache, capped in number of items (CACHE_MAX_ITEMS) and
+    in Bytes (CACHE_MAX_BYTES), with optional per-item TTL. Items are split
+    among several independent LRUs (stripes), each with its own lock and
+    share of the limits, not to have all the threads wait on a single lock """
+
+    stripes_count = 16
+
+    def __init__(self, max_items=None, max_bytes=None):
+        # defaults: 1k items, 100MiB
+        max_items = (CACHE_MAX_ITEMS or CACHE_SIZE or 1000) if max_items is None else max_items
+        max_bytes = (CACHE_MAX_BYTES or 100*1024**2) if max_bytes is None else max_bytes
+
+        count = max(1, min(self.stripes_count, max_items if max_items > 0 else self.stripes_count))
+
+        self.stripes = [CappedStripe(
+            max_items // count if max_items > 0 else 0,
+            max_bytes // count if max_bytes > 0 else 0) for i in range(count)]
+
+    def stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def __getitem__(self, key):
+        return self.stripe(key).get(key)
 
     def __setitem__(self, key, data):
-        # https://docs.python.org/2/library/collections.html#ordereddict-examples-and-recipes
-        if key in self:
-            del self[key]
-        OrderedDict.__setitem__(self, key, data)
+        self.set(key, data)
+
+    def set(self, key, data, ttl=None):
+        self.stripe(key).set(key, data, ttl)
+
+    def get_many(self, keys):
+        # one lock per stripe
+        by_stripe = {}
+
+        for key in keys:
+            by_stripe.setdefault(id(self.stripe(key)), (self.stripe(key), []))[1].append(key)
+
+        out = {}
+
+        for stripe, stripe_keys in by_stripe.values():
+            out.update(stripe.get_many(stripe_keys))
+
+        return out
+
+    def __delitem__(self, key):
+        self.stripe(key).delete(key)
+
+    def __contains__(self, key):
+        return self.stripe(key).contains(key)
+
+    def __len__(self):
+        return sum(len(x.items) for x in self.stripes)
+
+    def __bool__(self):
+        # always "true", even when empty, unlike a dict
+        return True
+
+    __nonzero__ = __bool__
+
+    def trim(self, deadline=None):
+        # size limits are enforced on insert, only expired items left to purge,
+        # one stripe at a time, starting where the previous call stopped
+        start = getattr(self, 'trim_next', 0)
+
+        for i in range(len(self.stripes)):
+            if deadline is not None and time.time() > deadline:
+                self.trim_next = (start + i) % len(self.stripes)
+                return
+
+            self.stripes[(start + i) % len(self.stripes)].purge()
+
+        self.trim_next = start
+
+    def stats(self):
+        stats = {'items': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+        for stripe in self.stripes:
+            with stripe.lock:
+                stats['items'] += len(stripe.items)
+                stats['bytes'] += stripe.size
+                stats['hits'] += stripe.hits
+                stats['misses'] += stripe.misses
+                stats['evictions'] += stripe.evictions
+
+        return stats
+
+
+def sizeof(data):
+    if isinstance(data, (bytes, str)):
+        return len(data)
+
+    else:
+        return sys.getsizeof(data)
+
+
+class CappedStripe:
+    " One of the LRUs behind CappedDict "
+
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items = OrderedDict() # key -> (data, size, expiry), oldest first
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+
+            if item is not None and item[2] is not None and item[2] < time.time():
+                # expired
+                self.remove(key)
+                item = None
+
+            if item is None:
+                self.misses += 1
+                raise KeyError(key)
+
+            self.items.move_to_end(key)
+            self.hits += 1
+
+            return item[0]
+
+    def get_many(self, keys):
+        out = {}
+
+        with self.lock:
+            now = time.time()
+
+            for key in keys:
+                item = self.items.get(key)
+
+                if item is None or (item[2] is not None and item[2] < now):
+                    self.misses += 1
+                    continue
+
+                self.items.move_to_end(key)
+                self.hits += 1
+                out[key] = item[0]
+
+        return out
+
+    def contains(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            return item is not None and (item[2] is None or item[2] >= time.time())
+
+    def set(self, key, data, ttl=None):
+        size = sizeof(key) + sizeof(data)
+        expiry = time.time() + ttl if ttl else None
+
+        with self.lock:
+            if key in self.items:
+                self.remove(key)
+
+            if self.max_bytes and size > self.max_bytes:
+                # would evict everything else, don't bother
+                return
+
+            self.items[key] = (data, size, expiry)
+            self.size += size
+
+            while ((self.max_bytes and self.size > self.max_bytes)
+                    or (self.max_items and len(self.items) > self.max_items)):
+                self.remove(next(iter(self.items)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self.items:
+                raise KeyError(key)
+
+            self.remove(key)
+
+    def remove(self, key):
+        # lock to be held by the caller
+        self.size -= self.items.pop(key)[1]
+
+    def purge(self):
+        now = time.time()
+
+        with self.lock:
+            for key in [k for (k, v) in self.items.items() if v[2] is not None and v[2] < now]:
+                self.remove(key)
 
 
 try:
@@ -70,14 +376,56 @@ except ImportError:
 
 
 class RedisCacheHandler(BaseCache):
-    def __init__(self, host='localhost', port=6379, db=0, password=None):
-        self.r = redis.Redis(host=host, port=port, db=db, password=password)
+    def __init__(self, host='localhost', port=6379, db=0, password=None, max_connections=50, timeout=5):
+        # connections shared by the threads, waiting (up to `timeout`) for
+        # one to be available rather than failing
+        pool = redis.BlockingConnectionPool(host=host, port=port, db=db, password=password,
+            max_connections=max_connections, timeout=timeout,
+            socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.r = redis.Redis(connection_pool=pool)
 
     def __getitem__(self, key):
-        return self.r.get(key)
+        data = self.r.get(key)
+
+        if data is None:
+            raise KeyError(key)
+
+        return data
 
     def __setitem__(self, key, data):
-        self.r.set(key, data)
+        self.set(key, data)
+
+    def set(self, key, data, ttl=None):
+        # expiry handled by redis itself
+        self.r.set(key, data, ex=int(ttl) if ttl else None)
+
+    def stats(self):
+        return {'items': self.r.dbsize(), 'bytes': self.r.info('memory').get('used_memory')}
+
+    def get_many(self, keys):
+        keys = list(keys)
+
+        if not keys:
+            return {}
+
+        return dict((key, data) for (key, data) in zip(keys, self.r.mget(keys)) if data is not None)
+
+    @contextmanager
+    def lock(self, key, timeout):
+        lock = self.r.lock('lock:' + key, timeout=timeout, blocking_timeout=timeout)
+        acquired = lock.acquire()
+
+        try:
+            yield
+
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+
+                except redis.exceptions.LockError:
+                    # expired in the meantime
+                    pass
 
 
 try:
@@ -87,14 +435,69 @@ except ImportError:
 
 
 class DiskCacheHandler(BaseCache):
-    def __init__(self, directory=None, **kwargs):
-        self.cache = diskcache.Cache(directory=directory, eviction_policy='least-frequently-used', **kwargs)
+    def __init__(self, directory=None, shards=1, max_items=0, **kwargs):
+        if shards > 1:
+            # one sqlite database (and write lock) per shard
+            self.cache = diskcache.FanoutCache(directory=directory, shards=shards, eviction_policy='least-frequently-used', **kwargs)
+
+        else:
+            self.cache = diskcache.Cache(directory=directory, eviction_policy='least-frequently-used', **kwargs)
+
+        self.max_items = max_items
+        self.evictions = 0 # by trim, on top of diskcache's own
 
     def __del__(self):
         self.cache.close()
 
-    def trim(self):
-        self.cache.cull()
+    def trim(self, deadline=None):
+        # expired items and size_limit (in Bytes), in small batches (so not to
+        # block the other threads for too long), one shard at a time, starting
+        # where the previous call stopped
+        shards = getattr(self.cache, '_shards', [self.cache])
+        start = getattr(self, 'trim_next', 0)
+
+        for i in range(len(shards)):
+            if not self.cull(shards[(start + i) % len(shards)], deadline):
+                self.trim_next = (start + i) % len(shards)
+                return
+
+        self.trim_next = start
+
+        if self.max_items > 0:
+            while deadline is None or time.time() < deadline:
+                excess = len(self.cache) - self.max_items
+
+                if excess <= 0:
+                    break
+
+                # no access to diskcache's eviction order, in key order then
+                for key in list(islice(iter(self.cache), min(excess, 100))):
+                    if self.cache.delete(key):
+                        self.evictions += 1
+
+    @staticmethod
+    def cull(shard, deadline=None):
+        " Same as shard.cull(), 100 items at a time. False if stopped by `deadline` "
+
+        if not hasattr(shard, '_cull'):
+            # diskcache internals changed, can't be done in batches
+            shard.cull()
+            return True
+
+        while deadline is None or time.time() < deadline:
+            count = len(shard)
+
+            with shard._transact() as (sql, cleanup):
+                shard._cull(time.time(), sql, cleanup, 100)
+
+            if len(shard) == count:
+                # nothing left to remove
+                return True
+
+        return False
+
+    def stats(self):
+        return {'items': len(self.cache), 'bytes': self.cache.volume(), 'evictions': self.evictions}
 
     def __getitem__(self, key):
         return self.cache[key]
@@ -102,6 +505,180 @@ class DiskCacheHandler(BaseCache):
     def __setitem__(self, key, data):
         self.cache.set(key, data)
 
+    def set(self, key, data, ttl=None):
+        self.cache.set(key, data, expire=ttl)
+
+    def get_many(self, keys):
+        out = {}
+        missing = object()
+
+        # a single transaction (fanout caches would have to lock all shards)
+        with self.cache.transact() if isinstance(self.cache, diskcache.Cache) else nullcontext():
+            for key in keys:
+                data = self.cache.get(key, default=missing)
+
+                if data is not missing:
+                    out[key] = data
+
+        return out
+
+    def lock(self, key, timeout):
+        return diskcache.Lock(self.cache, 'lock:' + key, expire=timeout)
+
+
+class PrefetchedCache(BaseCache):
+    """ View of `cache` with the given `keys` loaded at once, for the lookups
+    on these keys not to hit the backend anymore. Writes go through """
+
+    def __init__(self, cache, keys):
+        self.cache = cache
+        self.keys = set(keys)
+        self.data = cache.get_many(self.keys)
+
+    def __getitem__(self, key):
+        if key in self.data:
+            return self.data[key]
+
+        elif key in self.keys:
+            # known to be missing
+            raise KeyError(key)
+
+        else:
+            return self.cache[key]
+
+    def __setitem__(self, key, data):
+        self.set(key, data)
+
+    def set(self, key, data, ttl=None):
+        self.cache.set(key, data, ttl)
+
+        if key in self.keys:
+            self.data[key] = data
+
+    def is_local(self, key):
+        return key in self.keys or self.cache.is_local(key)
+
+    def get_many(self, keys):
+        keys = set(keys)
+        out = dict((key, self.data[key]) for key in keys & set(self.data))
+        out.update(self.cache.get_many(keys - self.keys))
+
+        return out
+
+    @contextmanager
+    def lock(self, key, timeout):
+        with self.cache.lock(key, timeout):
+            # might have been changed by whoever held the lock
+            self.keys.discard(key)
+            self.data.pop(key, None)
+
+            yield
+
+
+class TieredCache(BaseCache):
+    """ Small & short-lived in-memory cache (l1, a CappedDict) in front of a
+    shared one (l2, e.g. redis). Writes go to both. Missing keys are
+    remembered too (for `ttl` as well). Changes made to l2 by other processes
+    might take up to `ttl` sec to be seen """
+
+    def __init__(self, l1, l2, ttl):
+        self.l1 = l1
+        self.l2 = l2
+        self.ttl = ttl
+        self.lock_stats = threading.Lock()
+        self.counts = {'l1_hits': 0, 'l1_negative_hits': 0, 'l2_hits': 0, 'l2_misses': 0}
+
+    def count(self, name, n=1):
+        if n:
+            with self.lock_stats:
+                self.counts[name] += n
+
+    def __getitem__(self, key):
+        try:
+            data = self.l1[key]
+
+        except KeyError:
+            pass
+
+        else:
+            if data is MISSING:
+                self.count('l1_negative_hits')
+                raise KeyError(key)
+
+            self.count('l1_hits')
+            return data
+
+        try:
+            data = self.l2[key]
+
+        except KeyError:
+            self.count('l2_misses')
+            self.l1.set(key, MISSING, self.ttl)
+            raise
+
+        self.count('l2_hits')
+        self.l1.set(key, data, self.ttl)
+
+        return data
+
+    def __setitem__(self, key, data):
+        self.set(key, data)
+
+    def set(self, key, data, ttl=None):
+        self.l2.set(key, data, ttl)
+        self.l1.set(key, data, min(ttl, self.ttl) if ttl else self.ttl)
+
+    def get_many(self, keys):
+        keys = set(keys)
+        found = self.l1.get_many(keys)
+
+        out = dict((key, data) for (key, data) in found.items() if data is not MISSING)
+        self.count('l1_hits', len(out))
+        self.count('l1_negative_hits', len(found) - len(out))
+
+        rest = keys - set(found)
+        loaded = self.l2.get_many(rest) if rest else {}
+        self.count('l2_hits', len(loaded))
+        self.count('l2_misses', len(rest) - len(loaded))
+
+        for key in rest:
+            self.l1.set(key, loaded.get(key, MISSING), self.ttl)
+
+        out.update(loaded)
+
+        return out
+
+    def is_local(self, key):
+        return key in self.l1
+
+    def trim(self, deadline=None):
+        self.l1.trim(deadline)
+        self.l2.trim(deadline)
+
+    def stats(self):
+        with self.lock_stats:
+            stats = dict(self.counts)
+
+        stats['l1'] = self.l1.stats()
+        stats['l2'] = self.l2.stats()
+
+        return stats
+
+    @contextmanager
+    def lock(self, key, timeout):
+        with self.l2.lock(key, timeout):
+            # might have been changed by whoever held the lock
+            try:
+                del self.l1[key]
+
+            except KeyError:
+                pass
+
+            yield
+
+
+MISSING = object() # placeholder, for TieredCache to remember missing keys
+
 
 if 'CACHE' in os.environ:
     if os.environ['CACHE'] == 'redis':
@@ -109,14 +686,21 @@ if 'CACHE' in os.environ:
             host = os.getenv('REDIS_HOST', 'localhost'),
             port = int(os.getenv('REDIS_PORT', 6379)),
             db = int(os.getenv('REDIS_DB', 0)),
-            password = os.getenv('REDIS_PWD', None)
+            password = os.getenv('REDIS_PWD', None),
+            max_connections = int(os.getenv('REDIS_POOL_SIZE', 50)),
+            timeout = int(os.getenv('REDIS_TIMEOUT', 5))
         )
 
     elif os.environ['CACHE'] == 'diskcache':
         default_cache = DiskCacheHandler(
             directory = os.getenv('DISKCACHE_DIR', '/tmp/morss-diskcache'),
-            size_limit = CACHE_SIZE # in Bytes
+            shards = DISKCACHE_SHARDS,
+            max_items = CACHE_MAX_ITEMS,
+            size_limit = (CACHE_MAX_BYTES or CACHE_SIZE or 1024**3) if CACHE_MAX_BYTES >= 0 else 2**62 # in Bytes, default: 1GiB
         )
 
+    if CACHE_L1_TTL > 0:
+        default_cache = TieredCache(CappedDict(max_bytes=CACHE_L1_BYTES), default_cache, CACHE_L1_TTL)
+
 else:
         default_cache = CappedDict()
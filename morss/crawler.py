@@ -16,44 +16,41 @@
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import pickle
 import random
 import re
 import sys
-import time
+import threading
 import zlib
-from cgi import parse_header
-from collections import OrderedDict
-from io import BytesIO, StringIO
+from io import BytesIO
 
-import chardet
+from .asynchttp import async_open
+from .httpcache import CacheHandler
+from .pool import PooledHTTPHandler, PooledHTTPSHandler
+from .responses import (ACCEPT_ENCODING, BodyResponse, SizeLimitHandler,
+                        detect_encoding, get_decoder, read_body)
 
-from .caching import default_cache
+# moved to their own modules, still available from here
+# pylint: disable=unused-import
+from .httpcache import decode_entry, encode_entry
+from .pool import ConnectionPool, default_pool
+from .responses import error_response, parse_headers
+# pylint: enable=unused-import
 
 try:
     # python 2
     from urllib import quote
 
-    from httplib import HTTPMessage
-    from urllib2 import (BaseHandler, HTTPCookieProcessor, HTTPRedirectHandler,
-                         Request, addinfourl, build_opener, parse_http_list,
-                         parse_keqv_list)
+    from httplib import HTTPException
+    from urllib2 import (BaseHandler, HTTPCookieProcessor, HTTPError,
+                         HTTPRedirectHandler, Request, build_opener)
     from urlparse import urlsplit
 except ImportError:
     # python 3
-    from email import message_from_string
-    from http.client import HTTPMessage
+    from http.client import HTTPException
+    from urllib.error import HTTPError
     from urllib.parse import quote, urlsplit
     from urllib.request import (BaseHandler, HTTPCookieProcessor,
-                                HTTPRedirectHandler, Request, addinfourl,
-                                build_opener, parse_http_list, parse_keqv_list)
-
-try:
-    # python 2
-    basestring
-except NameError:
-    # python 3
-    basestring = unicode = str
+                                HTTPRedirectHandler, Request, build_opener)
 
 
 MIMETYPE = {
@@ -89,19 +86,147 @@ def get(*args, **kwargs):
 def adv_get(url, post=None, timeout=None, *args, **kwargs):
     url = sanitize_url(url)
 
+    if post is not None:
+        # not to be shared
+        return adv_fetch(url, post, timeout, *args, **kwargs)
+
+    # concurrent calls for the same url (in this process) share the same fetch
+    key = (url, timeout, args, tuple(sorted((k, v) for (k, v) in kwargs.items() if k != 'cache')))
+
+    return dict(in_flight.do(key, adv_fetch, url, post, timeout, *args, **kwargs))
+
+
+def adv_fetch(url, post=None, timeout=None, *args, **kwargs):
     if post is not None:
         post = post.encode('utf-8')
 
-    if timeout is None:
-        con = custom_opener(*args, **kwargs).open(url, data=post)
+    opener = custom_opener(*args, **kwargs)
+    req = Request(url, post)
 
-    else:
-        con = custom_opener(*args, **kwargs).open(url, data=post, timeout=timeout)
+    def fetch(req):
+        if timeout is None:
+            return opener.open(req)
+
+        else:
+            return opener.open(req, timeout=timeout)
+
+    try:
+        try:
+            con = fetch(req)
+
+        except HTTPError:
+            raise
+
+        except (IOError, HTTPException):
+            stale = stale_request(req)
+
+            if stale is None:
+                raise
 
+            con = fetch(stale)
+
+    finally:
+        # fetch locks left over by network errors, see CacheHandler.go_online
+        for handler in opener.handlers:
+            if isinstance(handler, CacheHandler):
+                handler.release_thread()
+
+    return adv_result(con)
+
+
+def stale_request(req):
+    """ After a network error on `req`, a request for its cached page if
+    CacheHandler said it could still be used (stale-if-error), else None """
+
+    if not getattr(req, 'stale_if_error', False):
+        return None
+
+    stale = Request(req.get_full_url(), req.data)
+    stale.cache_stale = True
+
+    return stale
+
+
+class SingleFlight:
+    " Runs a function once for all the concurrent calls with the same key "
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # key -> [event, result, error]
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = [threading.Event(), None, None]
+
+        if not leader:
+            call[0].wait()
+
+            if call[2] is not None:
+                raise call[2]
+
+            return call[1]
+
+        try:
+            call[1] = func(*args, **kwargs)
+            return call[1]
+
+        except Exception as e:
+            call[2] = e
+            raise
+
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+            call[0].set()
+
+
+in_flight = SingleFlight()
+
+
+async def adv_get_async(url, post=None, timeout=None, *args, **kwargs):
+    " Same as adv_get, with the network part running on the asyncio event loop "
+
+    url = sanitize_url(url)
+
+    if post is not None:
+        post = post.encode('utf-8')
+
+    opener = custom_opener(*args, **kwargs)
+    req = Request(url, post)
+
+    try:
+        con = await async_open(opener, req, timeout=timeout)
+
+    except HTTPError:
+        raise
+
+    except (IOError, HTTPException):
+        stale = stale_request(req)
+
+        if stale is None:
+            raise
+
+        con = await async_open(opener, stale, timeout=timeout)
+
+    return adv_result(con)
+
+
+def adv_result(con):
     data = con.read()
 
     contenttype = con.info().get('Content-Type', '').split(';')[0]
-    encoding= detect_encoding(data, con)
+
+    if isinstance(con, BodyResponse):
+        # most likely already detected by the handlers
+        encoding = con.get_encoding()
+
+    else:
+        encoding = detect_encoding(data, con)
 
     return {
         'data': data,
@@ -112,7 +237,7 @@ def adv_get(url, post=None, timeout=None, *args, **kwargs):
     }
 
 
-def custom_opener(follow=None, policy=None, force_min=None, force_max=None):
+def custom_opener(follow=None, policy=None, force_min=None, force_max=None, stale_while_revalidate=None, stale_if_error=None, cache=None):
     # as per urllib2 source code, these Handelers are added first
     # *unless* one of the custom handlers inherits from one of them
     #
@@ -141,12 +266,15 @@ def custom_opener(follow=None, policy=None, force_min=None, force_max=None):
         UAHandler(random.choice(DEFAULT_UAS)),
         BrowserlyHeaderHandler(),
         EncodingFixHandler(),
+        PooledHTTPHandler(),
+        PooledHTTPSHandler(),
     ]
 
     if follow:
         handlers.append(AlternateHandler(MIMETYPE[follow]))
 
-    handlers.append(CacheHandler(policy=policy, force_min=force_min, force_max=force_max))
+    handlers.append(CacheHandler(cache=cache, policy=policy, force_min=force_min, force_max=force_max,
+        stale_while_revalidate=stale_while_revalidate, stale_if_error=stale_if_error))
 
     return build_opener(*handlers)
 
@@ -212,16 +340,16 @@ class RespDataHandler(BaseHandler):
 
     def http_response(self, req, resp):
         # read data
-        data = resp.read()
+        if not isinstance(resp, BodyResponse):
+            resp = BodyResponse.from_response(resp)
 
         # process data and use returned content (if any)
-        data = self.data_response(req, resp, data) or data
+        data = self.data_response(req, resp, resp.data)
 
-        # reformat the stuff
-        fp = BytesIO(data)
-        old_resp = resp
-        resp = addinfourl(fp, old_resp.headers, old_resp.url, old_resp.code)
-        resp.msg = old_resp.msg
+        # reformat the stuff (unchanged bodies keep the same response, and
+        # what was decoded with it)
+        if data:
+            resp = BodyResponse.from_response(resp, data)
 
         return resp
 
@@ -235,18 +363,15 @@ class RespStrHandler(RespDataHandler):
         pass
 
     def data_response(self, req, resp, data):
-        #decode
-        enc = detect_encoding(data, resp)
-        data_str = data.decode(enc, 'replace')
+        #decode (only once for all the handlers, see BodyResponse)
+        enc, data_str = resp.get_text()
 
         #process
         data_str = self.str_response(req, resp, data_str)
 
-        # return
-        data = data_str.encode(enc) if data_str is not None else data
-
         #return
-        return data
+        if data_str is not None:
+            return data_str.encode(enc)
 
 
 class DebugHandler(BaseHandler):
@@ -264,96 +389,36 @@ class DebugHandler(BaseHandler):
     https_response = http_response
 
 
-class SizeLimitHandler(BaseHandler):
-    """ Limit file size, defaults to 5MiB """
-
-    handler_order = 450
-
-    def __init__(self, limit=5*1024**2):
-        self.limit = limit
-
-    def http_response(self, req, resp):
-        data = resp.read(self.limit)
-
-        fp = BytesIO(data)
-        old_resp = resp
-        resp = addinfourl(fp, old_resp.headers, old_resp.url, old_resp.code)
-        resp.msg = old_resp.msg
-
-        return resp
-
-    https_response = http_response
-
-
 def UnGzip(data):
     " Supports truncated files "
     return zlib.decompressobj(zlib.MAX_WBITS | 32).decompress(data)
 
 
 class GZIPHandler(RespDataHandler):
+    " Content negotiation, for all the supported (i.e. importable) compressions "
+
     def http_request(self, req):
-        req.add_unredirected_header('Accept-Encoding', 'gzip')
+        req.add_unredirected_header('Accept-Encoding', ACCEPT_ENCODING)
         return req
 
     def data_response(self, req, resp, data):
+        # usually already taken care of by SizeLimitHandler
         if 200 <= resp.code < 300:
-            if resp.headers.get('Content-Encoding') == 'gzip':
-                resp.headers['Content-Encoding'] = 'identity'
-
-                return UnGzip(data)
-
-
-def detect_encoding(data, resp=None):
-    enc = detect_raw_encoding(data, resp)
-
-    # Normalize Chinese encodings to GBK for better compatibility
-    # GB2312 is a subset of GBK, and GB18030 is a superset of GBK
-    # Using GBK provides the best balance for decoding Chinese content
-    if enc.lower() in ('gb2312', 'gbk', 'gb18030'):
-        enc = 'gbk'
+            decoder = get_decoder(resp.headers.get('Content-Encoding', '').strip().lower())
 
-    return enc
-
-
-def detect_raw_encoding(data, resp=None):
-    if resp is not None:
-        enc = resp.headers.get('charset')
-        if enc is not None:
-            return enc
-
-        enc = parse_header(resp.headers.get('content-type', ''))[1].get('charset')
-        if enc is not None:
-            return enc
-
-    match = re.search(b'charset=["\']?([0-9a-zA-Z-]+)', data[:1000])
-    if match:
-        return match.groups()[0].lower().decode()
-
-    match = re.search(b'encoding=["\']?([0-9a-zA-Z-]+)', data[:1000])
-    if match:
-        return match.groups()[0].lower().decode()
-
-    # Use a more representative sample for chardet: start + middle + end
-    # This helps detect encoding more accurately, especially for pages with
-    # mixed content or when encoding hints are at the beginning
-    if len(data) > 6000:
-        # Take samples from beginning, middle, and end
-        mid_start = max(0, len(data)//2 - 1000)
-        mid_end = len(data)//2 + 1000
-        sample = data[:2000] + data[mid_start:mid_end] + data[-2000:]
-    else:
-        sample = data
-    
-    enc = chardet.detect(sample)['encoding']
-    if enc and enc != 'ascii':
-        return enc
+            if decoder is not None:
+                del resp.headers['Content-Encoding']
+                resp.headers['Content-Encoding'] = 'identity'
 
-    return 'utf-8'
+                limits = [x.limit for x in getattr(self.parent, 'handlers', []) if isinstance(x, SizeLimitHandler)]
+                return read_body(BytesIO(data), min(limits or [SizeLimitHandler.default_limit]), decoder)
 
 
 class EncodingFixHandler(RespStrHandler):
     def str_response(self, req, resp, data_str):
-        return data_str
+        if resp.is_lossy():
+            # re-encode, to get rid of the invalid sequences
+            return data_str
 
 
 class UAHandler(BaseHandler):
@@ -398,20 +463,42 @@ class AlternateHandler(RespStrHandler):
     def __init__(self, follow=None):
         self.follow = follow or []
 
-    def str_response(self, req, resp, data_str):
+    def is_candidate(self, resp):
         contenttype = resp.info().get('Content-Type', '').split(';')[0]
+        return 200 <= resp.code < 300 and len(self.follow) and contenttype in MIMETYPE['html'] and contenttype not in self.follow
 
-        if 200 <= resp.code < 300 and len(self.follow) and contenttype in MIMETYPE['html'] and contenttype not in self.follow:
+    def find_alternate(self, data_str):
+        for link in iter_html_tag(data_str[:10000], 'link'):
+            if (link.get('rel') == 'alternate'
+                    and link.get('type') in self.follow
+                    and 'href' in link):
+                return link.get('href')
+
+        return None
+
+    def data_enough(self, req, resp, data):
+        # called by SizeLimitHandler while reading: once the first 10KB are
+        # there, no need for the rest of the page if it has an alternate link
+
+        if len(data) < 10000 or getattr(req, 'alternate_checked', False):
+            return False
+
+        req.alternate_checked = True
+
+        # latin-1 is good enough to find the tags, the link itself is
+        # properly decoded by str_response
+        return bool(self.is_candidate(resp) and self.find_alternate(data[:10000].decode('iso-8859-1')))
+
+    def str_response(self, req, resp, data_str):
+        if self.is_candidate(resp):
             # opps, not what we were looking for, let's see if the html page suggests an alternative page of the right types
 
-            for link in iter_html_tag(data_str[:10000], 'link'):
-                if (link.get('rel') == 'alternate'
-                        and link.get('type') in self.follow
-                        and 'href' in link):
-                    resp.code = 302
-                    resp.msg = 'Moved Temporarily'
-                    resp.headers['location'] = link.get('href')
-                    break
+            href = self.find_alternate(data_str)
+
+            if href is not None:
+                resp.code = 302
+                resp.msg = 'Moved Temporarily'
+                resp.headers['location'] = href
 
 
 class HTTPEquivHandler(RespStrHandler):
@@ -455,237 +542,6 @@ class HTTPRefreshHandler(BaseHandler):
     https_response = http_response
 
 
-def parse_headers(text=u'\n\n'):
-    if sys.version_info[0] >= 3:
-        # python 3
-        return message_from_string(text, _class=HTTPMessage)
-
-    else:
-        # python 2
-        return HTTPMessage(StringIO(text))
-
-
-def error_response(code, msg, url=''):
-    # return an error as a response
-    resp = addinfourl(BytesIO(), parse_headers(), url, code)
-    resp.msg = msg
-    return resp
-
-
-class CacheHandler(BaseHandler):
-    " Cache based on etags/last-modified "
-
-    privacy = 'private' # Websites can indicate whether the page should be cached
-                        # by CDNs (e.g. shouldn't be the case for
-                        # private/confidential/user-specific pages. With this
-                        # setting, decide whether you want the cache to behave
-                        # like a CDN (i.e. don't cache private pages, 'public'),
-                        # or to behave like a end-user private pages
-                        # ('private'). If unsure, 'public' is the safest bet,
-                        # but many websites abuse this feature...
-
-                      # NB. This overrides all the other min/max/policy settings.
-    handler_order = 499
-
-    def __init__(self, cache=None, force_min=None, force_max=None, policy=None):
-        self.cache = cache or default_cache
-        self.force_min = force_min
-        self.force_max = force_max
-        self.policy = policy # can be cached/refresh/offline/None (default)
-
-        # Servers indicate how long they think their content is "valid". With
-        # this parameter (force_min/max, expressed in seconds), we can override
-        # the validity period (i.e. bypassing http headers)
-        # Special choices, via "policy":
-        #   cached: use the cache no matter what (and fetch the page online if
-        #           not present in cache)
-        #   refresh: valid zero second, i.e. force refresh
-        #   offline: same as cached, i.e. use the cache no matter what, but do
-        #            NOT fetch the page online if not present in cache, throw an
-        #            error instead
-        #   None: just follow protocols
-
-        # sanity checks
-        assert self.force_max is None or self.force_max >= 0
-        assert self.force_min is None or self.force_min >= 0
-        assert self.force_max is None or self.force_min is None or self.force_max >= self.force_min
-
-    def load(self, url):
-        try:
-            data = pickle.loads(self.cache[url])
-
-        except KeyError:
-            data = None
-
-        else:
-            data['headers'] = parse_headers(data['headers'] or unicode())
-
-        return data
-
-    def save(self, key, data):
-        data['headers'] = unicode(data['headers'])
-        self.cache[key] = pickle.dumps(data, 0)
-
-    def cached_response(self, req, fallback=None):
-        req.from_morss_cache = True
-
-        data = self.load(req.get_full_url())
-
-        if data is not None:
-            # return the cache as a response
-            resp = addinfourl(BytesIO(data['data']), data['headers'], req.get_full_url(), data['code'])
-            resp.msg = data['msg']
-            return resp
-
-        else:
-            return fallback
-
-    def save_response(self, req, resp):
-        if req.from_morss_cache:
-            # do not re-save (would reset the timing)
-            return resp
-
-        data = resp.read()
-
-        self.save(req.get_full_url(), {
-            'code': resp.code,
-            'msg': resp.msg,
-            'headers': resp.headers,
-            'data': data,
-            'timestamp': time.time()
-            })
-
-        fp = BytesIO(data)
-        old_resp = resp
-        resp = addinfourl(fp, old_resp.headers, old_resp.url, old_resp.code)
-        resp.msg = old_resp.msg
-
-        return resp
-
-    def http_request(self, req):
-        req.from_morss_cache = False # to track whether it comes from cache
-
-        data = self.load(req.get_full_url())
-
-        if data is not None:
-            if 'etag' in data['headers']:
-                req.add_unredirected_header('If-None-Match', data['headers']['etag'])
-
-            if 'last-modified' in data['headers']:
-                req.add_unredirected_header('If-Modified-Since', data['headers']['last-modified'])
-
-        return req
-
-    def http_open(self, req):
-        # Reminder of how/when this function is called by urllib2:
-        # If 'None' is returned, try your chance with the next-available handler
-        # If a 'resp' is returned, stop there, and proceed with 'http_response'
-
-        # Here, we try to see whether we want to use data from cache (i.e.
-        # return 'resp'), or whether we want to refresh the content (return
-        # 'None')
-
-        data = self.load(req.get_full_url())
-
-        if data is not None:
-            # some info needed to process everything
-            cache_control = parse_http_list(data['headers'].get('cache-control', ()))
-            cache_control += parse_http_list(data['headers'].get('pragma', ()))
-
-            cc_list = [x for x in cache_control if '=' not in x]
-            cc_values = parse_keqv_list([x for x in cache_control if '=' in x])
-
-            cache_age = time.time() - data['timestamp']
-
-        # list in a simple way what to do in special cases
-
-        if data is not None and 'private' in cc_list and self.privacy == 'public':
-            # private data but public cache, do not use cache
-            # privacy concern, so handled first and foremost
-            # (and doesn't need to be addressed anymore afterwards)
-            return None
-
-        elif self.policy == 'offline':
-            # use cache, or return an error
-            return self.cached_response(
-                req,
-                error_response(409, 'Conflict', req.get_full_url())
-            )
-
-        elif self.policy == 'cached':
-            # use cache, or fetch online
-            return self.cached_response(req, None)
-
-        elif self.policy == 'refresh':
-            # force refresh
-            return None
-
-        elif data is None:
-            # we have already settled all the cases that don't need the cache.
-            # all the following ones need the cached item
-            return None
-
-        elif self.force_max is not None and cache_age > self.force_max:
-            # older than we want, refresh
-            return None
-
-        elif self.force_min is not None and cache_age < self.force_min:
-            # recent enough, use cache
-            return self.cached_response(req)
-
-        elif data['code'] == 301 and cache_age < 7*24*3600:
-            # "301 Moved Permanently" has to be cached...as long as we want
-            # (awesome HTTP specs), let's say a week (why not?). Use force_min=0
-            # if you want to bypass this (needed for a proper refresh)
-            return self.cached_response(req)
-
-        elif self.force_min is None and ('no-cache' in cc_list or 'no-store' in cc_list):
-            # kindly follow web servers indications, refresh if the same
-            # settings are used all along, this section shouldn't be of any use,
-            # since the page woudln't be cached in the first place the check is
-            # only performed "just in case"
-            # NB. NOT respected if force_min is set
-            return None
-
-        elif 'max-age' in cc_values and int(cc_values['max-age']) > cache_age:
-            # server says it's still fine (and we trust him, if not, use overrides), use cache
-            return self.cached_response(req)
-
-        else:
-            # according to the www, we have to refresh when nothing is said
-            return None
-
-    def http_response(self, req, resp):
-        # code for after-fetch, to know whether to save to hard-drive (if sticking to http headers' will)
-
-        if resp.code == 304 and resp.url in self.cache:
-            # we are hopefully the first after the HTTP handler, so no need
-            # to re-run all the *_response
-            # here: cached page, returning from cache
-            return self.cached_response(req)
-
-        elif self.force_min is None and ('cache-control' in resp.headers or 'pragma' in resp.headers):
-            cache_control = parse_http_list(resp.headers.get('cache-control', ()))
-            cache_control += parse_http_list(resp.headers.get('pragma', ()))
-
-            cc_list = [x for x in cache_control if '=' not in x]
-
-            if 'no-cache' in cc_list or 'no-store' in cc_list or ('private' in cc_list and self.privacy == 'public'):
-                # kindly follow web servers indications (do not save & return)
-                return resp
-
-            else:
-                # save
-                return self.save_response(req, resp)
-
-        else:
-            return self.save_response(req, resp)
-
-    https_request = http_request
-    https_open = http_open
-    https_response = http_response
-
-
 if 'IGNORE_SSL' in os.environ:
     import ssl
     ssl._create_default_https_context = ssl._create_unverified_context
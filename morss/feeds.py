@@ -16,8 +16,10 @@
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import csv
+import heapq
 import json
 import re
+from collections import deque
 from copy import deepcopy
 from datetime import datetime
 from fnmatch import fnmatch
@@ -28,17 +30,15 @@ from dateutil import tz
 from lxml import etree
 
 from .readabilite import parse as html_parse
-from .util import *
+from .rules import compile_xpath, parse_rules
 
 json.encoder.c_make_encoder = None
 
 try:
     # python 2
-    from ConfigParser import RawConfigParser
     from StringIO import StringIO
 except ImportError:
     # python 3
-    from configparser import RawConfigParser
     from io import StringIO
 
 try:
@@ -49,35 +49,9 @@ except NameError:
     basestring = unicode = str
 
 
-def parse_rules(filename=None):
-    if not filename:
-        filename = pkg_path('feedify.ini')
-
-    config = RawConfigParser()
-    config.read(filename)
-
-    rules = dict([(x, dict(config.items(x))) for x in config.sections()])
-
-    for section in rules.keys():
-        # for each ruleset
-
-        for arg in rules[section].keys():
-            # for each rule
-
-            if rules[section][arg].startswith('file:'):
-                path = data_path('www', rules[section][arg][5:])
-                file_raw = open(path).read()
-                file_clean = re.sub('<[/?]?(xsl|xml)[^>]+?>', '', file_raw)
-                rules[section][arg] = file_clean
-
-            elif '\n' in rules[section][arg]:
-                rules[section][arg] = rules[section][arg].split('\n')[1:]
-
-    return rules
-
-
-def parse(data, url=None, encoding=None, ruleset=None):
-    " Determine which ruleset to use "
+def parse(data, url=None, encoding=None, ruleset=None, max_items=None, order=None):
+    """ Determine which ruleset to use. With `max_items`, xml feeds are parsed
+    as a stream, only keeping that many items (see `order`) """
 
     if ruleset is not None:
         rulesets = [ruleset]
@@ -95,7 +69,7 @@ def parse(data, url=None, encoding=None, ruleset=None):
                 for path in ruleset['path']:
                     if fnmatch(url, path):
                         parser = [x for x in parsers if x.mode == ruleset.get('mode')][0] # FIXME what if no mode specified?
-                        return parser(data, ruleset, encoding=encoding)
+                        return parser(data, ruleset, encoding=encoding, max_items=max_items, order=order)
 
     # 2) Try each and every parser
 
@@ -105,7 +79,7 @@ def parse(data, url=None, encoding=None, ruleset=None):
 
     for parser in parsers:
         try:
-            feed = parser(data, encoding=encoding)
+            feed = parser(data, encoding=encoding, max_items=max_items, order=order)
 
         except (ValueError, SyntaxError):
             # parsing did not work
@@ -136,7 +110,10 @@ def parse(data, url=None, encoding=None, ruleset=None):
 
 
 class ParserBase(object):
-    def __init__(self, data=None, rules=None, parent=None, encoding=None):
+    max_items = None
+    order = None
+
+    def __init__(self, data=None, rules=None, parent=None, encoding=None, max_items=None, order=None):
         if rules is None:
             rules = parse_rules()[self.default_ruleset]
 
@@ -147,6 +124,8 @@ class ParserBase(object):
 
         self.parent = parent
         self.encoding = encoding
+        self.max_items = max_items if max_items is not None and max_items > 0 else None # parse() needs an item to pick a ruleset
+        self.order = order
 
         self.root = self.parse(data)
 
@@ -323,10 +302,86 @@ class ParserXML(ParserBase):
         'content': 'http://purl.org/rss/1.0/modules/content/',
         'rssfake': 'http://purl.org/rss/1.0/'}
 
+    ITEM_TAGS = ('item', '{%s}item' % NSMAP['rssfake'], '{%s}entry' % NSMAP['atom'], '{%s}entry' % NSMAP['atom03'])
+    STREAM_CHUNK = 64*1024
+
     def parse(self, raw):
+        if self.max_items is not None:
+            return self.parse_stream(raw)
+
         parser = etree.XMLParser(recover=True, remove_blank_text=True, remove_pis=True) # remove_blank_text needed for pretty_print
         return etree.fromstring(raw, parser)
 
+    def parse_stream(self, raw):
+        """ Only keeps `max_items` items, the other ones being dropped (and
+        freed) as they are parsed """
+
+        parser = etree.XMLPullParser(events=('end',), tag=self.ITEM_TAGS, recover=True, remove_blank_text=True, remove_pis=True)
+
+        if self.order in ('newest', 'oldest'):
+            kept = [] # heap of (sort key, item)
+
+        else:
+            kept = deque()
+
+        now = datetime.now(tz.tzutc()).timestamp()
+        count = 0
+
+        for i in range(0, len(raw), self.STREAM_CHUNK):
+            parser.feed(raw[i:i+self.STREAM_CHUNK])
+
+            for event, elem in parser.read_events():
+                count += 1
+
+                if self.order in ('newest', 'oldest'):
+                    time = self._item_time(elem)
+                    stamp = time.timestamp() if time is not None else now
+                    key = (stamp, count) if self.order == 'newest' else (-stamp, -count) # ties as with a stable sort
+                    heapq.heappush(kept, (key, elem))
+
+                    if len(kept) > self.max_items:
+                        self._drop_node(heapq.heappop(kept)[1])
+
+                elif self.order == 'last':
+                    kept.append(elem)
+
+                    if len(kept) > self.max_items:
+                        self._drop_node(kept.popleft())
+
+                elif len(kept) < self.max_items:
+                    kept.append(elem)
+
+                else:
+                    self._drop_node(elem)
+
+        root = parser.close()
+
+        if root is not None:
+            # for items within other items, or truncated ones
+            if self.order in ('newest', 'oldest'):
+                kept = [elem for (key, elem) in kept]
+
+            kept = set(kept)
+
+            for elem in list(root.iter(*self.ITEM_TAGS)):
+                if elem not in kept:
+                    self._drop_node(elem)
+
+        return root
+
+    @staticmethod
+    def _drop_node(xml):
+        parent = xml.getparent()
+
+        if parent is not None:
+            xml.clear()
+            parent.remove(xml)
+
+    def _item_time(self, xml):
+        # same as `item.updated or item.time` for items that can't be wrapped yet
+        fields = dict((etree.QName(x).localname, x.text) for x in xml if isinstance(x.tag, str))
+        return self.time_prs(fields.get('updated')) or self.time_prs(fields.get('published') or fields.get('pubDate'))
+
     def remove(self):
         return self.root.getparent().remove(self.root)
 
@@ -361,7 +416,7 @@ class ParserXML(ParserBase):
 
     def rule_search_all(self, rule):
         try:
-            match = self.root.xpath(rule, namespaces=self.NSMAP)
+            match = compile_xpath(rule, self.NSMAP, self.mode)(self.root)
             if isinstance(match, str):
                 # some xpath rules return a single string instead of an array (e.g. concatenate() )
                 return [match,]
@@ -369,7 +424,7 @@ class ParserXML(ParserBase):
             else:
                 return match
 
-        except etree.XPathEvalError:
+        except etree.XPathError:
             return []
 
     def rule_create(self, rule):
@@ -485,12 +540,7 @@ class ParserHTML(ParserXML):
 
     def rule_search_all(self, rule):
         try:
-            # do proper "class" matching (too "heavy" to type as-it in rules)
-            pattern = r'\[class=([^\]]+)\]'
-            repl = r'[@class and contains(concat(" ", normalize-space(@class), " "), " \1 ")]'
-            rule = re.sub(pattern, repl, rule)
-
-            match = self.root.xpath(rule)
+            match = compile_xpath(rule, None, self.mode)(self.root)
 
             if isinstance(match, str):
                 # for some xpath rules, see XML parser
@@ -499,7 +549,7 @@ class ParserHTML(ParserXML):
             else:
                 return match
 
-        except etree.XPathEvalError:
+        except etree.XPathError:
             return []
 
     def rule_create(self, rule):
@@ -652,7 +702,15 @@ def wrap_uniq(wrapper_fn_name):
             # This is called when the wrapped function is called
 
             output = func(self, *args, **kwargs)
-            output_id = id(output)
+
+            try:
+                # the node itself (kept alive by the map), so that it's stable
+                hash(output)
+                output_id = output
+
+            except TypeError:
+                # e.g. dict with json feeds
+                output_id = id(output)
 
             try:
                 return self._map[output_id]
@@ -687,8 +745,23 @@ class Feed(object):
     items = property(
         lambda f:   f )
 
+    def get_items(self):
+        " Cached list of the raw items, only looked up again after append/remove "
+
+        rule = self.rules.get('items')
+        cached = getattr(self, '_items_cache', None)
+
+        if cached is None or cached[0] != rule:
+            cached = self._items_cache = (rule, self.get_raw('items'))
+
+        return cached[1]
+
+    def items_changed(self):
+        self._items_cache = None
+
     def append(self, new=None):
         self.rule_create(self.rules['items'])
+        self.items_changed()
         item = self.items[-1]
 
         for attr in self.itemsClass.dic:
@@ -709,28 +782,55 @@ class Feed(object):
 
     @wrap_uniq('wrap_item')
     def __getitem__(self, key):
-        return self.get_raw('items')[key]
+        return self.get_items()[key]
 
     def __delitem__(self, key):
         self[key].remove()
 
     def __len__(self):
-        return len(self.get_raw('items'))
+        return len(self.get_items())
 
 
 class Item(object):
     dic = ('title', 'link', 'desc', 'content', 'time', 'updated')
+    field_cache = True # keep the values read, set to False when editing .root directly
 
     def __init__(self, xml=None, rules=None, parent=None):
         self._id = self._gen_id(xml)
+        self._fields = {}
         self.root = xml
         self.rules = rules
         self.parent = parent
 
+    def get(self, rule_name):
+        if not self.field_cache:
+            return super(Item, self).get(rule_name)
+
+        try:
+            return self._fields[rule_name]
+
+        except KeyError:
+            value = self._fields[rule_name] = super(Item, self).get(rule_name)
+            return value
+
+    def set(self, rule_name, value):
+        super(Item, self).set(rule_name, value)
+        self._fields.clear() # rules might overlap (e.g. desc and content), so forget everything
+
+    def rmv(self, rule_name):
+        super(Item, self).rmv(rule_name)
+        self._fields.clear()
+
     @staticmethod
     def _gen_id(xml=None, *args, **kwargs):
         return id(xml)
 
+    def remove(self):
+        super(Item, self).remove()
+
+        if self.parent is not None:
+            self.parent.items_changed()
+
     title = property(
         lambda f:   f.get('item_title'),
         lambda f,x: f.set('item_title', x),
@@ -806,6 +906,7 @@ class ItemJSON(Item, ParserJSON):
         for node in rrule:
             if node == '[]':
                 cur.remove(self.root)
+                self.parent.items_changed()
                 return
 
             cur = cur[node]
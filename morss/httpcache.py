@@ -0,0 +1,553 @@
+# This file is part of morss
+#
+# Copyright (C) 2013-2020 pictuga <contact@pictuga.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import pickle
+import socket
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import caching
+from .responses import BodyResponse, error_response, parse_headers
+
+try:
+    # python 2
+    from httplib import HTTPMessage
+    from urllib2 import BaseHandler, Request, parse_http_list, parse_keqv_list
+except ImportError:
+    # python 3
+    from http.client import HTTPMessage
+    from urllib.request import (BaseHandler, Request, parse_http_list,
+                                parse_keqv_list)
+
+try:
+    # python 2
+    basestring
+except NameError:
+    # python 3
+    basestring = unicode = str
+
+
+# Cache entries: fixed-size binary header, then the status message, the headers
+# needed later on (one "name: value" per line) and the (maybe compressed) body
+
+ENTRY_MAGIC = b'MRS'
+ENTRY_VERSION = 1
+ENTRY_HEADER = struct.Struct('>3sBBHdHI') # magic, version, flags, code, timestamp, len(msg), len(headers)
+ENTRY_ZLIB = 1 # flags
+ENTRY_ZSTD = 2
+
+ENTRY_HEADERS = ('content-type', 'content-encoding', 'charset', 'cache-control',
+    'pragma', 'expires', 'etag', 'last-modified', 'location', 'refresh')
+
+ENTRY_COMPRESS_MIN = 1024 # don't bother compressing smaller bodies (in Bytes)
+
+
+class CacheEntry(dict):
+    " Cache entry, the headers & body only being decoded when first accessed "
+
+    def __init__(self, raw, flags, headers_pos, data_pos, **kwargs):
+        dict.__init__(self, **kwargs)
+        self.raw = raw
+        self.flags = flags
+        self.headers_pos = headers_pos
+        self.data_pos = data_pos
+
+    def __missing__(self, key):
+        if key == 'headers':
+            value = HTTPMessage()
+
+            for line in self.raw[self.headers_pos:self.data_pos].decode('utf-8').splitlines():
+                name, _, header = line.partition(': ')
+                value[name] = header
+
+        elif key == 'data':
+            value = self.raw[self.data_pos:]
+
+            if self.flags & ENTRY_ZSTD:
+                value = zstandard.ZstdDecompressor().decompress(value)
+
+            elif self.flags & ENTRY_ZLIB:
+                value = zlib.decompress(value)
+
+        else:
+            raise KeyError(key)
+
+        self[key] = value
+        return value
+
+
+def encode_entry(data):
+    msg = (data['msg'] or '').encode('utf-8')
+
+    headers = data['headers']
+
+    if isinstance(headers, basestring):
+        headers = parse_headers(headers or unicode())
+
+    headers = ''.join('%s: %s\n' % (name, value) for (name, value) in headers.items()
+        if name.lower() in ENTRY_HEADERS).encode('utf-8')
+
+    body = data['data']
+    flags = 0
+
+    if len(body) >= ENTRY_COMPRESS_MIN:
+        if zstandard is not None:
+            packed = zstandard.ZstdCompressor().compress(body)
+            flag = ENTRY_ZSTD
+
+        else:
+            packed = zlib.compress(body)
+            flag = ENTRY_ZLIB
+
+        if len(packed) < len(body):
+            body = packed
+            flags |= flag
+
+    header = ENTRY_HEADER.pack(ENTRY_MAGIC, ENTRY_VERSION, flags, data['code'], data['timestamp'], len(msg), len(headers))
+
+    return header + msg + headers + body
+
+
+def decode_entry(raw):
+    " Returns a dict-like CacheEntry, supports entries from older versions (pickle) "
+
+    if not raw.startswith(ENTRY_MAGIC):
+        data = pickle.loads(raw)
+        data['headers'] = parse_headers(data['headers'] or unicode())
+        return data
+
+    (magic, version, flags, code, timestamp, msg_len, headers_len) = ENTRY_HEADER.unpack_from(raw)
+
+    if version != ENTRY_VERSION:
+        # from the future? just ignore it
+        raise KeyError('unsupported cache entry version')
+
+    if flags & ~(ENTRY_ZLIB | ENTRY_ZSTD) or (flags & ENTRY_ZSTD and zstandard is None):
+        # e.g. from another process with zstandard installed, can't be read here
+        raise KeyError('unsupported cache entry compression')
+
+    msg_pos = ENTRY_HEADER.size
+    headers_pos = msg_pos + msg_len
+    data_pos = headers_pos + headers_len
+
+    return CacheEntry(raw, flags, headers_pos, data_pos,
+        code=code, msg=raw[msg_pos:headers_pos].decode('utf-8'), timestamp=timestamp)
+
+
+revalidating = set() # urls being refreshed in the background
+revalidating_lock = threading.Lock()
+
+
+class CacheHandler(BaseHandler):
+    " Cache based on etags/last-modified "
+
+    privacy = 'private' # Websites can indicate whether the page should be cached
+                        # by CDNs (e.g. shouldn't be the case for
+                        # private/confidential/user-specific pages. With this
+                        # setting, decide whether you want the cache to behave
+                        # like a CDN (i.e. don't cache private pages, 'public'),
+                        # or to behave like a end-user private pages
+                        # ('private'). If unsure, 'public' is the safest bet,
+                        # but many websites abuse this feature...
+
+                      # NB. This overrides all the other min/max/policy settings.
+    handler_order = 499
+
+    def __init__(self, cache=None, force_min=None, force_max=None, policy=None, stale_while_revalidate=None, stale_if_error=None):
+        self.cache = cache if cache is not None else caching.default_cache
+        self.force_min = force_min
+        self.force_max = force_max
+        self.policy = policy # can be cached/refresh/offline/None (default)
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+
+        self.held = {} # req -> (thread id, fetch lock), see go_online
+        self.held_lock = threading.Lock()
+
+        # Servers indicate how long they think their content is "valid". With
+        # this parameter (force_min/max, expressed in seconds), we can override
+        # the validity period (i.e. bypassing http headers)
+        # Special choices, via "policy":
+        #   cached: use the cache no matter what (and fetch the page online if
+        #           not present in cache)
+        #   refresh: valid zero second, i.e. force refresh
+        #   offline: same as cached, i.e. use the cache no matter what, but do
+        #            NOT fetch the page online if not present in cache, throw an
+        #            error instead
+        #   None: just follow protocols
+
+        # Once outdated, a page can still be used for a little while (rfc5861,
+        # in sec, if None, as per the server's Cache-Control, otherwise none):
+        #   stale_while_revalidate: serve the cached page right away, and
+        #                           refresh it in the background
+        #   stale_if_error: serve the cached page if the server can't be
+        #                   reached or returns a 5xx error
+
+        # sanity checks
+        assert self.force_max is None or self.force_max >= 0
+        assert self.force_min is None or self.force_min >= 0
+        assert self.force_max is None or self.force_min is None or self.force_max >= self.force_min
+
+    backend_calls = 0 # number of reads/writes reaching the cache backends, see count_call
+    backend_lock = threading.Lock()
+
+    @classmethod
+    def count_call(cls):
+        with cls.backend_lock:
+            cls.backend_calls += 1
+
+    def load(self, url):
+        if not self.cache.is_local(url):
+            # i.e. not answered by PrefetchedCache/TieredCache
+            self.count_call()
+
+        try:
+            return decode_entry(self.cache[url])
+
+        except KeyError:
+            return None
+
+    def load_entry(self, req):
+        " Same as load, but only once per request "
+
+        url = req.get_full_url()
+        memo = getattr(req, 'cache_entry', None)
+
+        if memo is None or memo[0] != url:
+            memo = req.cache_entry = (url, self.load(url))
+
+        return memo[1]
+
+    def save(self, key, data):
+        self.count_call()
+        self.cache.set(key, encode_entry(data), self.entry_ttl(data))
+
+    def entry_ttl(self, data):
+        " How long the entry can be of use (in sec), for the cache backends with expiry "
+
+        cache_control = parse_http_list(data['headers'].get('cache-control', ()))
+        cc_values = parse_keqv_list([x for x in cache_control if '=' in x])
+
+        ttl = max([0, self.force_min or 0, self.force_max or 0]
+            + ([int(cc_values['max-age'])] if cc_values.get('max-age', '').isdigit() else [])
+            + ([7*24*3600] if data['code'] == 301 else []))
+
+        ttl += max(self.stale_window(self.stale_while_revalidate, cc_values, 'stale-while-revalidate'),
+            self.stale_window(self.stale_if_error, cc_values, 'stale-if-error'))
+
+        # still useful afterwards for conditional requests & offline use
+        return max(ttl, caching.CACHE_TTL)
+
+    def cached_response(self, req, fallback=None):
+        req.from_morss_cache = True
+
+        data = self.load_entry(req)
+
+        if data is not None:
+            # return the cache as a response
+            return BodyResponse(data['data'], data['headers'], req.get_full_url(), data['code'], data['msg'])
+
+        else:
+            return fallback
+
+    def save_response(self, req, resp):
+        if req.from_morss_cache:
+            # do not re-save (would reset the timing)
+            return resp
+
+        if getattr(resp, 'truncated', False):
+            # only the beginning of the page was read, it'd be served as the whole page
+            return resp
+
+        if not isinstance(resp, BodyResponse):
+            resp = BodyResponse.from_response(resp)
+
+        self.save(req.get_full_url(), {
+            'code': resp.code,
+            'msg': resp.msg,
+            'headers': resp.headers,
+            'data': resp.data,
+            'timestamp': time.time()
+            })
+
+        return resp
+
+    def stale_window(self, value, cc_values, directive):
+        if value is not None:
+            return value
+
+        elif cc_values.get(directive, '').isdigit():
+            return int(cc_values[directive])
+
+        else:
+            return 0
+
+    def stale_response(self, req, staleness, cc_values):
+        " The cached page is outdated by `staleness` sec, see whether it can still be used "
+
+        if staleness < self.stale_window(self.stale_while_revalidate, cc_values, 'stale-while-revalidate'):
+            self.revalidate(req)
+            return self.cached_response(req)
+
+        elif staleness < self.stale_window(self.stale_if_error, cc_values, 'stale-if-error'):
+            # go online, the cached page being used on 5xx errors (see
+            # cache_response) or network errors (see stale_request)
+            req.stale_if_error = True
+            return None
+
+        else:
+            return None
+
+    def revalidate(self, req):
+        " Refresh the cached page in the background (once at a time per url) "
+
+        url = req.get_full_url()
+
+        with revalidating_lock:
+            if url in revalidating:
+                return
+
+            revalidating.add(url)
+
+        def run():
+            try:
+                new = Request(url)
+                new.cache_revalidate = True
+                self.parent.open(new, timeout=getattr(req, 'timeout', socket._GLOBAL_DEFAULT_TIMEOUT))
+
+            except Exception:
+                pass
+
+            finally:
+                self.release_thread()
+
+                with revalidating_lock:
+                    revalidating.discard(url)
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def go_online(self, req):
+        """ About to fetch the page. With CACHE_LOCK, first wait for the other
+        processes fetching it, and use what they got. The lock is held until
+        the page is saved (http_response) """
+
+        if not caching.CACHE_LOCK or req.data is not None or getattr(req, 'is_async', False):
+            return None
+
+        old = self.load_entry(req)
+
+        lock = self.cache.lock(req.get_full_url(), caching.CACHE_LOCK)
+        lock.__enter__()
+
+        with self.held_lock:
+            self.held[req] = (threading.get_ident(), lock)
+
+        # reload, in case someone else just fetched it
+        req.cache_entry = None
+        new = self.load_entry(req)
+
+        if self.policy != 'refresh' and new is not None and (old is None or new['timestamp'] != old['timestamp']):
+            self.release(req)
+            return self.cached_response(req)
+
+        return None
+
+    def release(self, req):
+        with self.held_lock:
+            held = self.held.pop(req, None)
+
+        if held is not None:
+            held[1].__exit__(None, None, None)
+
+    def release_thread(self):
+        " Release the locks of the current thread (e.g. after network errors) "
+
+        with self.held_lock:
+            reqs = [req for (req, (ident, lock)) in self.held.items() if ident == threading.get_ident()]
+
+        for req in reqs:
+            self.release(req)
+
+    def http_request(self, req):
+        req.from_morss_cache = False # to track whether it comes from cache
+        req.cache_entry = None
+
+        data = self.load_entry(req)
+
+        if data is not None:
+            if 'etag' in data['headers']:
+                req.add_unredirected_header('If-None-Match', data['headers']['etag'])
+
+            if 'last-modified' in data['headers']:
+                req.add_unredirected_header('If-Modified-Since', data['headers']['last-modified'])
+
+        return req
+
+    def http_open(self, req):
+        resp = self.cache_open(req)
+
+        if resp is None and self.policy != 'offline':
+            # going online
+            return self.go_online(req)
+
+        return resp
+
+    def cache_open(self, req):
+        # Reminder of how/when this function is called by urllib2:
+        # If 'None' is returned, try your chance with the next-available handler
+        # If a 'resp' is returned, stop there, and proceed with 'http_response'
+
+        # Here, we try to see whether we want to use data from cache (i.e.
+        # return 'resp'), or whether we want to refresh the content (return
+        # 'None')
+
+        if getattr(req, 'cache_stale', False):
+            # the server can't be reached, see stale_request
+            return self.cached_response(req)
+
+        elif getattr(req, 'cache_revalidate', False):
+            # called from revalidate, go online
+            return None
+
+        data = self.load_entry(req)
+
+        if data is not None:
+            # some info needed to process everything
+            cache_control = parse_http_list(data['headers'].get('cache-control', ()))
+            cache_control += parse_http_list(data['headers'].get('pragma', ()))
+
+            cc_list = [x for x in cache_control if '=' not in x]
+            cc_values = parse_keqv_list([x for x in cache_control if '=' in x])
+
+            cache_age = time.time() - data['timestamp']
+
+        # list in a simple way what to do in special cases
+
+        if data is not None and 'private' in cc_list and self.privacy == 'public':
+            # private data but public cache, do not use cache
+            # privacy concern, so handled first and foremost
+            # (and doesn't need to be addressed anymore afterwards)
+            return None
+
+        elif self.policy == 'offline':
+            # use cache, or return an error
+            return self.cached_response(
+                req,
+                error_response(409, 'Conflict', req.get_full_url())
+            )
+
+        elif self.policy == 'cached':
+            # use cache, or fetch online
+            return self.cached_response(req, None)
+
+        elif self.policy == 'refresh':
+            # force refresh
+            return None
+
+        elif data is None:
+            # we have already settled all the cases that don't need the cache.
+            # all the following ones need the cached item
+            return None
+
+        elif self.force_max is not None and cache_age > self.force_max:
+            # older than we want, refresh
+            return self.stale_response(req, cache_age - self.force_max, cc_values)
+
+        elif self.force_min is not None and cache_age < self.force_min:
+            # recent enough, use cache
+            return self.cached_response(req)
+
+        elif data['code'] == 301 and cache_age < 7*24*3600:
+            # "301 Moved Permanently" has to be cached...as long as we want
+            # (awesome HTTP specs), let's say a week (why not?). Use force_min=0
+            # if you want to bypass this (needed for a proper refresh)
+            return self.cached_response(req)
+
+        elif self.force_min is None and ('no-cache' in cc_list or 'no-store' in cc_list):
+            # kindly follow web servers indications, refresh if the same
+            # settings are used all along, this section shouldn't be of any use,
+            # since the page woudln't be cached in the first place the check is
+            # only performed "just in case"
+            # NB. NOT respected if force_min is set
+            return None
+
+        elif 'max-age' in cc_values and int(cc_values['max-age']) > cache_age:
+            # server says it's still fine (and we trust him, if not, use overrides), use cache
+            return self.cached_response(req)
+
+        else:
+            # according to the www, we have to refresh when nothing is said
+            max_age = int(cc_values['max-age']) if cc_values.get('max-age', '').isdigit() else 0
+            return self.stale_response(req, cache_age - max_age, cc_values)
+
+    def http_response(self, req, resp):
+        try:
+            return self.cache_response(req, resp)
+
+        finally:
+            self.release(req)
+
+    def cache_response(self, req, resp):
+        # code for after-fetch, to know whether to save to hard-drive (if sticking to http headers' will)
+
+        data = self.load_entry(req)
+
+        if resp.code == 304 and data is not None:
+            # we are hopefully the first after the HTTP handler, so no need
+            # to re-run all the *_response
+            # here: cached page, returning from cache. Still valid, so the
+            # cached page's age is reset
+            data['timestamp'] = time.time()
+            self.save(req.get_full_url(), data)
+
+            resp.close()
+            return self.cached_response(req)
+
+        elif resp.code >= 500 and getattr(req, 'stale_if_error', False) and data is not None:
+            # server error, outdated cache is better than nothing
+            resp.close()
+            return self.cached_response(req)
+
+        elif self.force_min is None and ('cache-control' in resp.headers or 'pragma' in resp.headers):
+            cache_control = parse_http_list(resp.headers.get('cache-control', ()))
+            cache_control += parse_http_list(resp.headers.get('pragma', ()))
+
+            cc_list = [x for x in cache_control if '=' not in x]
+
+            if 'no-cache' in cc_list or 'no-store' in cc_list or ('private' in cc_list and self.privacy == 'public'):
+                # kindly follow web servers indications (do not save & return)
+                return resp
+
+            else:
+                # save
+                return self.save_response(req, resp)
+
+        else:
+            return self.save_response(req, resp)
+
+    https_request = http_request
+    https_open = http_open
+    https_response = http_response
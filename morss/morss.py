@@ -15,11 +15,16 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import hashlib
 import html as _html_module
+import json
 import os
 import re
-import sys
+import threading
 import time
+from collections import deque
+from concurrent import futures
 from datetime import datetime
 from fnmatch import fnmatch
 
@@ -28,14 +33,19 @@ import lxml.html
 from dateutil import tz
 
 from . import caching, crawler, feeds, readabilite
+from .util import log
+from .webproxy import (convert_absolute_url_to_proxy,
+                       extract_target_from_proxy, web_proxy_join)
 
 try:
     # python 2
     from httplib import HTTPException
+    from urllib2 import HTTPError
     from urlparse import parse_qs, urljoin, urlparse
 except ImportError:
     # python 3
     from http.client import HTTPException
+    from urllib.error import HTTPError
     from urllib.parse import parse_qs, urljoin, urlparse
 
 
@@ -48,20 +58,93 @@ LIM_TIME = int(os.getenv('LIM_TIME', 2.5)) # deletes what's after
 DELAY = int(os.getenv('DELAY', 10 * 60)) # xml cache & ETag cache (in sec)
 TIMEOUT = int(os.getenv('TIMEOUT', 4)) # http timeout (in sec)
 
+STALE_WHILE_REVALIDATE = int(os.getenv('STALE_WHILE_REVALIDATE', 60 * 60)) # outdated feed served while refreshed in the background (in sec)
+STALE_IF_ERROR = int(os.getenv('STALE_IF_ERROR', 24 * 60 * 60)) # outdated feed served when the server fails (in sec)
+
+THREADS = int(os.getenv('THREADS', 1)) # articles fetched in parallel (1: one at a time)
+THREADS_PER_HOST = int(os.getenv('THREADS_PER_HOST', 4)) # parallel fetches on a given website
+
+FAIL_DELAY = int(os.getenv('FAIL_DELAY', 60)) # cache-only after a failed fetch, doubled on each new failure (in sec, 0: disabled)
+FAIL_DELAY_MAX = int(os.getenv('FAIL_DELAY_MAX', 24 * 60 * 60)) # upper bound of the above (in sec)
+FAIL_HOST = 3 # consecutive failures for the whole website to be skipped
+
 
 class MorssException(Exception):
     pass
 
 
-def log(txt):
-    if 'DEBUG' in os.environ:
-        if 'REQUEST_URI' in os.environ:
-            # when running on Apache
-            open('morss.log', 'a').write("%s\n" % repr(txt))
+failures = caching.CappedDict(max_items=10000, max_bytes=-1) # 'url:...'/'host:...' -> (count, until)
 
-        else:
-            # when using internal server or cli
-            print(repr(txt), file=sys.stderr)
+
+def failure_keys(url, host=True):
+    if host:
+        return ('url:' + url, 'host:' + urlparse(url).netloc)
+
+    else:
+        return ('url:' + url,)
+
+
+def is_host_failure(error):
+    " Whether the error is about the website as a whole (timeout, connection error, 5xx), not just that page "
+
+    if isinstance(error, HTTPError):
+        return error.code >= 500
+
+    return True
+
+
+def is_known_bad(url, host=True):
+    """ Whether `url` (or, with `host`, its website) failed recently, i.e. not
+    worth trying again yet """
+
+    if not url or FAIL_DELAY <= 0:
+        return False
+
+    now = time.time()
+
+    for key in failure_keys(url, host):
+        try:
+            count, until = failures[key]
+
+        except KeyError:
+            continue
+
+        if until > now and (key.startswith('url:') or count >= FAIL_HOST):
+            return True
+
+    return False
+
+
+def record_failure(url, host=True):
+    " Exponential backoff, per url and (with `host`) per website "
+
+    if not url or FAIL_DELAY <= 0:
+        return
+
+    for key in failure_keys(url, host):
+        try:
+            count, until = failures[key]
+
+        except KeyError:
+            count = 0
+
+        count += 1
+        delay = min(FAIL_DELAY * 2 ** min(count - 1, 30), FAIL_DELAY_MAX)
+
+        # kept beyond `until`, for the next failure to get a longer delay
+        failures.set(key, (count, time.time() + delay), max(2 * delay, FAIL_DELAY_MAX))
+
+
+def record_success(url, host=True):
+    if not url or FAIL_DELAY <= 0:
+        return
+
+    for key in failure_keys(url, host):
+        try:
+            del failures[key]
+
+        except KeyError:
+            pass
 
 
 def len_html(txt):
@@ -104,136 +187,6 @@ class Options:
     get = __getitem__ = __getattr__
 
 
-def extract_target_from_proxy(web_proxy):
-    """
-    Extract the target base URL from a web proxy URL.
-    
-    Args:
-        web_proxy: The web proxy prefix URL (e.g., 'https://proxy.com/https/target.com')
-    
-    Returns:
-        The target base URL (e.g., 'https://target.com') or None if not found
-    
-    Examples:
-        'https://proxy.saha.qzz.io/https/www.target.com' -> 'https://www.target.com'
-        'https://sitedl.westpan.me/123/https/t66y.com' -> 'https://t66y.com'
-        'https://proxy.com/view/http://target.com' -> 'http://target.com'
-    """
-    # Remove trailing slash
-    web_proxy = web_proxy.rstrip('/')
-    
-    # Try to find embedded URL in two patterns:
-    # Pattern 1: .../http://domain or .../https://domain (full URL with :// in path)
-    # Pattern 2: .../http/domain or .../https/domain (protocol and domain separated)
-    
-    # Look for http:// or https:// in the path (after the proxy domain)
-    # Search for last occurrence of /http:// or /https://
-    MIN_SCHEME_LENGTH = len('http://')  # Minimum length for a valid URL scheme
-    for protocol in ['https://', 'http://']:
-        search_str = '/' + protocol
-        idx = web_proxy.rfind(search_str)
-        if idx != -1 and idx > MIN_SCHEME_LENGTH:  # Make sure it's not the beginning of the URL
-            # Extract the embedded URL
-            return web_proxy[idx + 1:]
-    
-    # Pattern 2: Protocol and domain separated by slashes
-    # Split the proxy URL by '/'
-    parts = web_proxy.split('/')
-    
-    # Look for protocol indicators (http or https) in the path
-    # Format: https://proxy.domain/{arbitrary_path}/{protocol}/{target.domain}
-    for i, part in enumerate(parts[3:], start=3):  # Start after scheme and domain
-        if part in ('http', 'https'):
-            # Found protocol indicator, next part should be the target domain
-            if i + 1 < len(parts):
-                target_protocol = part
-                target_domain = parts[i + 1]
-                return f"{target_protocol}://{target_domain}"
-    
-    return None
-
-
-def web_proxy_join(web_proxy, relative_link):
-    """
-    Concatenate web_proxy prefix with relative link, handling double slashes.
-    
-    Args:
-        web_proxy: The web proxy prefix URL (e.g., 'https://proxy.com/view/http/target.com')
-        relative_link: The relative link extracted from the page (e.g., '/foo/bar.html')
-    
-    Returns:
-        The concatenated URL with proper slash handling
-    """
-    # Remove trailing slash from proxy if present
-    web_proxy = web_proxy.rstrip('/')
-    
-    # Ensure relative_link starts with a slash
-    if not relative_link.startswith('/'):
-        relative_link = '/' + relative_link
-    
-    # Concatenate
-    return web_proxy + relative_link
-
-
-def convert_absolute_url_to_proxy(web_proxy, absolute_url):
-    """
-    Convert an absolute URL to use the web proxy format.
-    
-    Args:
-        web_proxy: The web proxy prefix URL (e.g., 'https://proxy.com/view/http/target.com')
-        absolute_url: The absolute URL to convert (e.g., 'https://example.com/page')
-    
-    Returns:
-        The proxied URL
-    
-    Examples:
-        web_proxy='https://proxy.com/view/http/target.com'  (Pattern 2)
-        absolute_url='https://example.com/page'
-        
-        Returns: 'https://proxy.com/view/https/example.com/page'
-        
-        Supports both Pattern 1 (http://domain) and Pattern 2 (http/domain) proxy formats.
-    """
-    # Parse the web_proxy to understand its format
-    # Try to detect if it uses pattern 1 (embedded ://) or pattern 2 (protocol/domain)
-    
-    # Minimum length to ensure we're not matching the proxy's own protocol
-    MIN_PROTOCOL_LENGTH = len('http://')
-    
-    # First, check if web_proxy contains embedded URL with ://
-    if '/http://' in web_proxy or '/https://' in web_proxy:
-        # Pattern 1: embedded URL format (e.g., 'https://proxy.com/view/http://target.com')
-        # Extract the proxy base (everything before the last embedded URL)
-        # Use rfind to get the last occurrence, which should be the target URL
-        for protocol in ['https://', 'http://']:
-            search_str = '/' + protocol
-            idx = web_proxy.rfind(search_str)
-            # Verify this is after the proxy's own protocol (at least MIN_PROTOCOL_LENGTH chars in)
-            if idx != -1 and idx > MIN_PROTOCOL_LENGTH:
-                proxy_base = web_proxy[:idx]
-                # Construct new proxied URL by appending the absolute URL
-                return proxy_base + '/' + absolute_url
-    
-    # Pattern 2: protocol/domain format (e.g., 'https://proxy.com/123/https/target.com')
-    parts = web_proxy.split('/')
-    for i, part in enumerate(parts[3:], start=3):
-        if part in ('http', 'https'):
-            # Found protocol separator, proxy base is everything before it
-            proxy_base = '/'.join(parts[:i])
-            # Parse the absolute URL to get protocol and rest
-            parsed = urlparse(absolute_url)
-            protocol = parsed.scheme  # 'http' or 'https'
-            # domain and path combined - remove the scheme and '://'
-            domain_and_path = absolute_url[len(parsed.scheme + '://'):]
-            # Construct new proxied URL
-            return proxy_base + '/' + protocol + '/' + domain_and_path
-    
-    # Fallback: if we can't determine the pattern, return the original URL
-    # This is safer than trying string replacement which could fail
-    log(f'Unable to determine proxy pattern for {web_proxy}, returning original URL {absolute_url}')
-    return absolute_url
-
-
 def ItemFix(item, options, feedurl='/'):
     """ Improves feed items (absolute links, resolve feedburner links, etc) """
 
@@ -341,7 +294,7 @@ def ItemFix(item, options, feedurl='/'):
     return item
 
 
-def ItemFill(item, options, feedurl='/', fast=False):
+def ItemFill(item, options, feedurl='/', fast=False, cache=None):
     """ Returns True when it has done its best """
 
     if not item.link:
@@ -350,49 +303,179 @@ def ItemFill(item, options, feedurl='/', fast=False):
 
     log(item.link)
 
-    # download
+    article = ItemFetch(item.link, options, fast, cache)
+
+    return ItemStore(item, article, options)
+
+
+def ItemFetch(link, options, fast=False, cache=None):
+    """ Downloads & extracts the article. Doesn't touch the feed, so that it can
+    be run from worker threads. Returns None when there's nothing to fill in,
+    False on error """
+
+    policy = item_policy(options, fast)
+
+    try:
+        req = crawler.adv_get(url=link, policy=policy, force_min=24*60*60, timeout=TIMEOUT, cache=cache)
+
+    except (IOError, HTTPException) as e:
+        log('http error')
+
+        if policy != 'offline':
+            record_failure(link, is_host_failure(e))
+
+        return False # let's just delete errors stuff when in cache mode
+
+    if policy != 'offline':
+        record_success(link)
+
+    return ItemExtract(req, options, cache)
+
+
+async def ItemFetchAsync(link, options, fast=False, cache=None):
+    " Same as ItemFetch, with the download running on the asyncio event loop "
+
+    policy = item_policy(options, fast)
+
+    try:
+        req = await crawler.adv_get_async(url=link, policy=policy, force_min=24*60*60, timeout=TIMEOUT, cache=cache)
+
+    except (IOError, HTTPException) as e:
+        log('http error')
+
+        if policy != 'offline':
+            record_failure(link, is_host_failure(e))
+
+        return False
+
+    if policy != 'offline':
+        record_success(link)
+
+    # cache lookup & extraction, both blocking
+    return await asyncio.get_event_loop().run_in_executor(None, ItemExtract, req, options, cache)
 
+
+def item_policy(options, fast=False):
     if fast or options.cache:
         # force cache, don't fetch
-        policy = 'offline'
+        return 'offline'
 
     elif options.force:
         # force refresh
-        policy = 'refresh'
+        return 'refresh'
 
     else:
-        policy = None
+        return None
 
-    try:
-        req = crawler.adv_get(url=item.link, policy=policy, force_min=24*60*60, timeout=TIMEOUT)
 
-    except (IOError, HTTPException) as e:
-        log('http error')
-        return False # let's just delete errors stuff when in cache mode
+def ItemExtract(req, options, cache=None):
+    """ Second half of ItemFetch, once the page is downloaded. The result is
+    cached, the extraction being way slower than loading the page from cache """
 
     if req['contenttype'] not in crawler.MIMETYPE['html'] and req['contenttype'] != 'text/plain':
         log('non-text page')
-        return True
+        return None
 
     if not req['data']:
         log('empty page')
-        return True
+        return None
+
+    if cache is None:
+        cache = caching.default_cache
+
+    key = 'article:' + hashlib.sha1(repr((req['url'], hashlib.sha1(req['data']).hexdigest(), options.xpath,
+        readabilite.EXTRACTOR_VERSION, readabilite.TRAFILATURA_AVAILABLE)).encode('utf-8')).hexdigest()
+
+    try:
+        article = json.loads(cache[key].decode('utf-8'))
 
-    article = readabilite._get_article_data(req['data'], url=req['url'], encoding_in=req['encoding'], xpath=options.xpath)
+    except KeyError:
+        article = readabilite._get_article_data(req['data'], url=req['url'], encoding_in=req['encoding'], xpath=options.xpath)
+        article = {'content': article['content'], 'main_image': article.get('main_image')}
+        cache.set(key, json.dumps(article).encode('utf-8'), caching.CACHE_TTL)
+
+    return {
+        'content': article['content'],
+        'main_image': article['main_image'],
+        'url': req['url'],
+    }
+
+
+def ItemStore(item, article, options):
+    """ Writes the output of ItemFetch into the item. Same return value as
+    ItemFill """
+
+    if article is False:
+        return False
+
+    if article is None:
+        return True
 
     out = article['content']
     if out is not None:
-        main_image = article.get('main_image')
+        main_image = article['main_image']
         if main_image:
             out = '<p><img src="{}" alt=""/></p>\n'.format(_html_module.escape(main_image, quote=True)) + out
         item.content = out
 
     if options.resolve:
-        item.link = req['url']
+        item.link = article['url']
 
     return True
 
 
+class HostQueue:
+    """ Runs jobs in a thread pool, `limit` at a time per website. The other
+    jobs wait in line (without taking a worker), and are run by the worker of
+    the job before them, once it's done """
+
+    def __init__(self, pool, limit):
+        self.pool = pool
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.running = {} # host -> number of workers
+        self.waiting = {} # host -> deque of (future, func, args)
+
+    def submit(self, host, func, *args):
+        job = (futures.Future(), func, args)
+
+        with self.lock:
+            if self.running.get(host, 0) >= self.limit:
+                self.waiting[host].append(job)
+                return job[0]
+
+            self.running[host] = self.running.get(host, 0) + 1
+            self.waiting.setdefault(host, deque())
+
+        self.pool.submit(self.run, host, job)
+
+        return job[0]
+
+    def run(self, host, job):
+        while job is not None:
+            future, func, args = job
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+
+                except Exception as e:
+                    future.set_exception(e)
+
+            with self.lock:
+                if self.waiting[host]:
+                    job = self.waiting[host].popleft()
+
+                else:
+                    self.running[host] -= 1
+                    job = None
+
+
+async def ItemFetchLimitedAsync(semaphore, link, options, fast=False, cache=None):
+    async with semaphore:
+        return await ItemFetchAsync(link, options, fast, cache)
+
+
 def ItemBefore(item, options):
     # return None if item deleted
 
@@ -432,13 +515,21 @@ def FeedFetch(url, options):
     elif options.force:
         policy = 'refresh'
 
+    elif is_known_bad(url, host=False):
+        # failed recently, don't wait for it again (the articles' website might be another matter)
+        policy = 'offline'
+
     else:
         policy = None
 
     try:
-        req = crawler.adv_get(url=url, post=options.post, follow=('rss' if not options.items else None), policy=policy, force_min=5*60, force_max=60*60, timeout=TIMEOUT)
+        req = crawler.adv_get(url=url, post=options.post, follow=('rss' if not options.items else None), policy=policy, force_min=5*60, force_max=60*60,
+            stale_while_revalidate=STALE_WHILE_REVALIDATE, stale_if_error=STALE_IF_ERROR, timeout=TIMEOUT)
 
     except (IOError, HTTPException):
+        if policy != 'offline':
+            record_failure(url, host=False)
+
         raise MorssException('Error downloading feed')
 
     if options.items:
@@ -467,15 +558,23 @@ def FeedFetch(url, options):
 
     else:
         try:
-            rss = feeds.parse(req['data'], url=url, encoding=req['encoding'])
+            rss = feeds.parse(req['data'], url=url, encoding=req['encoding'], max_items=LIM_ITEM, order=options.order)
+                # items beyond LIM_ITEM would be dropped by FeedSelect anyway
             rss = rss.convert(feeds.FeedXML)
                 # contains all fields, otherwise much-needed data can be lost
 
         except TypeError:
             log('random page')
             log(req['contenttype'])
+            record_failure(url, host=False)
             raise MorssException('Link provided is not a valid feed')
 
+    if policy != 'offline':
+        record_success(url, host=False)
+
+    # what the output depends on, besides the options & the articles
+    rss.validator = req['con'].headers.get('etag') or hashlib.sha1(req['data']).hexdigest()
+
     return req['url'], rss
 
 
@@ -484,14 +583,65 @@ def FeedGather(rss, url, options):
     start_time = time.time()
 
     # custom settings
-    lim_item = LIM_ITEM
     lim_time = LIM_TIME
-    max_item = MAX_ITEM
     max_time = MAX_TIME
 
     if options.cache:
         max_time = 0
 
+    todo = FeedSelect(rss, url, options)
+    cache = FeedPrefetch(todo, options)
+
+    if THREADS > 1 and not options.proxy:
+        late = FeedFillParallel(todo, url, options, start_time, max_time, lim_time, cache)
+
+    else:
+        late = FeedFill(todo, url, options, start_time, max_time, lim_time, cache)
+
+    rss.complete = not late # i.e. not cut short by the time limits
+
+    FeedFinish(rss, options, start_time)
+
+    return rss
+
+
+async def FeedGatherAsync(rss, url, options):
+    " Same as FeedGather, with all the articles being fetched at once from the asyncio event loop "
+
+    start_time = time.time()
+
+    # custom settings
+    lim_time = LIM_TIME
+    max_time = MAX_TIME
+
+    if options.cache:
+        max_time = 0
+
+    todo = FeedSelect(rss, url, options)
+    cache = await asyncio.get_event_loop().run_in_executor(None, FeedPrefetch, todo, options)
+
+    if options.proxy:
+        late = FeedFill(todo, url, options, start_time, max_time, lim_time, cache)
+
+    else:
+        late = await FeedFillAsync(todo, url, options, start_time, max_time, lim_time, cache)
+
+    rss.complete = not late
+
+    FeedFinish(rss, options, start_time)
+
+    return rss
+
+
+def FeedSelect(rss, url, options):
+    """ Sorts the items, drops the ones beyond LIM_ITEM. Returns the list of
+    (item, fast, bad) to be filled, `fast` meaning from cache only, `bad` that
+    the link failed recently (so the item is to be kept even if not cached) """
+
+    # custom settings
+    lim_item = LIM_ITEM
+    max_item = MAX_ITEM
+
     # sort
     sorted_items = list(rss.items)
 
@@ -507,9 +657,12 @@ def FeedGather(rss, url, options):
         if options.order == 'newest':
             sorted_items = reversed(sorted_items)
 
+    # pick the items to work on
+    todo = []
+
     for i, item in enumerate(sorted_items):
-        # hard cap
-        if time.time() - start_time > lim_time >= 0 or i + 1 > lim_item >= 0:
+        # hard cap (on the number of items, the time one is checked while filling)
+        if i + 1 > lim_item >= 0:
             log('dropped')
             item.remove()
             continue
@@ -521,19 +674,70 @@ def FeedGather(rss, url, options):
 
         item = ItemFix(item, options, url)
 
+        # soft cap (on the number of items), and links that just failed
+        fast = i + 1 > max_item >= 0
+        bad = False
+
+        if not fast and not options.force and is_known_bad(item.link):
+            log('failed recently, using cache')
+            fast = bad = True
+
+        todo.append((item, fast, bad))
+
+    return todo
+
+
+def FeedPrefetch(todo, options):
+    """ Loads the cache entries of all the articles at once (e.g. a single
+    MGET with redis), returns a cache to be used while filling the items """
+
+    if options.proxy:
+        return None
+
+    links = [crawler.sanitize_url(item.link) for item, fast, bad in todo if item.link]
+
+    return caching.PrefetchedCache(caching.default_cache, links)
+
+
+def FeedFill(todo, url, options, start_time, max_time, lim_time, cache=None):
+    """ Fills the items one after the other. Returns the number of items
+    dropped or taken from cache because of the time limits """
+
+    late = 0
+
+    for item, fast, bad in todo:
+        # hard cap
+        if time.time() - start_time > lim_time >= 0:
+            log('dropped')
+            item.remove()
+            late += 1
+            continue
+
         # soft cap
-        if time.time() - start_time > max_time >= 0 or i + 1 > max_item >= 0:
-            if not options.proxy:
-                if ItemFill(item, options, url, True) is False:
-                    item.remove()
-                    continue
+        if not options.proxy:
+            if not fast and time.time() - start_time > max_time >= 0:
+                late += 1
 
-        else:
-            if not options.proxy:
-                ItemFill(item, options, url)
+            if fast or time.time() - start_time > max_time >= 0:
+                if ItemFill(item, options, url, True, cache) is False:
+                    if bad:
+                        # not cached, leave it as it is rather than dropping it
+                        log('failed recently, not cached')
+                        late += 1
+
+                    else:
+                        item.remove()
+                        continue
+
+            else:
+                ItemFill(item, options, url, cache=cache)
+
+        ItemAfter(item, options)
 
-        item = ItemAfter(item, options)
+    return late
 
+
+def FeedFinish(rss, options, start_time):
     if options.ad:
         new = rss.items.append()
         new.title = "Are you hungry?"
@@ -544,7 +748,170 @@ def FeedGather(rss, url, options):
     log(len(rss.items))
     log(time.time() - start_time)
 
-    return rss
+
+def FeedFillParallel(todo, url, options, start_time, max_time, lim_time, cache=None):
+    """ Same as FeedFill, with the downloads spread over a thread pool. The feed itself is only modified from the calling
+    thread, in the original order """
+
+    soft_deadline = start_time + max_time if max_time >= 0 else None
+    hard_deadline = start_time + lim_time if lim_time >= 0 else None
+
+    pool = futures.ThreadPoolExecutor(max_workers=THREADS)
+    queue = HostQueue(pool, THREADS_PER_HOST)
+    jobs = []
+    late = 0
+
+    for item, fast, bad in todo:
+        if not item.link:
+            jobs.append(None)
+            continue
+
+        jobs.append(queue.submit(urlparse(item.link).netloc, ItemFetch, item.link, options, fast, cache))
+
+    pool.shutdown(wait=False) # late downloads go on in the background (and fill the cache)
+
+    for (item, fast, bad), job in zip(todo, jobs):
+        # hard cap
+        if hard_deadline is not None and time.time() > hard_deadline:
+            log('dropped')
+            if job is not None:
+                job.cancel()
+            item.remove()
+            late += 1
+            continue
+
+        if job is None:
+            log('no link')
+            ItemAfter(item, options)
+            continue
+
+        log(item.link)
+
+        deadline = hard_deadline if fast else soft_deadline
+
+        try:
+            article = job.result(timeout=(max(deadline - time.time(), 0) if deadline is not None else None))
+
+        except futures.TimeoutError:
+            job.cancel()
+
+            late += 1
+
+            if fast and bad:
+                # failed recently, leave it as it is
+                log('failed recently, not cached')
+                ItemAfter(item, options)
+                continue
+
+            if fast:
+                # still nothing by the hard cap
+                log('dropped')
+                item.remove()
+                continue
+
+            # soft cap, fall back to the cache
+            log('late, using cache')
+            article = ItemFetch(item.link, options, True, cache)
+            fast = True
+
+        if ItemStore(item, article, options) is False and fast:
+            if bad:
+                # not cached, leave it as it is rather than dropping it
+                log('failed recently, not cached')
+                late += 1
+
+            else:
+                item.remove()
+                continue
+
+        ItemAfter(item, options)
+
+    return late
+
+
+async def FeedFillAsync(todo, url, options, start_time, max_time, lim_time, cache=None):
+    " Same as FeedFillParallel, with coroutines instead of threads "
+
+    soft_deadline = start_time + max_time if max_time >= 0 else None
+    hard_deadline = start_time + lim_time if lim_time >= 0 else None
+
+    hosts = {} # per-website semaphores
+    jobs = []
+    late = 0
+
+    for item, fast, bad in todo:
+        if not item.link:
+            jobs.append(None)
+            continue
+
+        host = urlparse(item.link).netloc
+
+        if host not in hosts:
+            hosts[host] = asyncio.Semaphore(THREADS_PER_HOST)
+
+        jobs.append(asyncio.ensure_future(ItemFetchLimitedAsync(hosts[host], item.link, options, fast, cache)))
+
+    try:
+        for (item, fast, bad), job in zip(todo, jobs):
+            # hard cap
+            if hard_deadline is not None and time.time() > hard_deadline:
+                log('dropped')
+                item.remove()
+                late += 1
+                continue
+
+            if job is None:
+                log('no link')
+                ItemAfter(item, options)
+                continue
+
+            log(item.link)
+
+            deadline = hard_deadline if fast else soft_deadline
+
+            try:
+                article = await asyncio.wait_for(asyncio.shield(job), (max(deadline - time.time(), 0) if deadline is not None else None))
+
+            except asyncio.TimeoutError:
+                job.cancel()
+
+                late += 1
+
+                if fast and bad:
+                    # failed recently, leave it as it is
+                    log('failed recently, not cached')
+                    ItemAfter(item, options)
+                    continue
+
+                if fast:
+                    # still nothing by the hard cap
+                    log('dropped')
+                    item.remove()
+                    continue
+
+                # soft cap, fall back to the cache (blocking, so in a thread)
+                log('late, using cache')
+                article = await asyncio.get_event_loop().run_in_executor(None, ItemFetch, item.link, options, True, cache)
+                fast = True
+
+            if ItemStore(item, article, options) is False and fast:
+                if bad:
+                    # not cached, leave it as it is rather than dropping it
+                    log('failed recently, not cached')
+                    late += 1
+
+                else:
+                    item.remove()
+                    continue
+
+            ItemAfter(item, options)
+
+    finally:
+        for job in jobs:
+            if job is not None:
+                job.cancel()
+
+    return late
 
 
 def FeedFormat(rss, options, encoding='utf-8'):
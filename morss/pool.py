@@ -0,0 +1,228 @@
+# This file is part of morss
+#
+# Copyright (C) 2013-2020 pictuga <contact@pictuga.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import socket
+import threading
+import time
+
+from .responses import CHUNK_SIZE
+
+try:
+    # python 2
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib2 import HTTPHandler, HTTPSHandler, URLError, addinfourl
+except ImportError:
+    # python 3
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib.error import URLError
+    from urllib.request import HTTPHandler, HTTPSHandler, addinfourl
+
+
+POOL_SIZE = int(os.getenv('POOL_SIZE', 20)) # max number of idle keep-alive connections
+POOL_TIMEOUT = int(os.getenv('POOL_TIMEOUT', 30)) # how long to keep idle connections (in sec)
+
+
+class ConnectionPool:
+    " Idle keep-alive connections, per (scheme, host:port) "
+
+    def __init__(self, maxsize=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = [] # (key, conn, last_used), oldest first
+
+    def get(self, key):
+        now = time.time()
+        conn = None
+
+        with self.lock:
+            expired = [x for x in self.idle if now - x[2] > self.timeout]
+            self.idle = [x for x in self.idle if now - x[2] <= self.timeout]
+
+            for i in reversed(range(len(self.idle))):
+                if self.idle[i][0] == key:
+                    conn = self.idle.pop(i)[1]
+                    break
+
+        for x in expired:
+            x[1].close()
+
+        return conn
+
+    def put(self, key, conn):
+        with self.lock:
+            self.idle.append((key, conn, time.time()))
+            dropped = self.idle[:max(len(self.idle) - self.maxsize, 0)]
+            self.idle = self.idle[len(dropped):]
+
+        for x in dropped:
+            x[1].close()
+
+    def clear(self):
+        with self.lock:
+            dropped = self.idle
+            self.idle = []
+
+        for x in dropped:
+            x[1].close()
+
+    def forget(self):
+        # drop connections without closing them (e.g. sockets inherited by a
+        # forked process, which still belong to the parent)
+        self.idle = []
+        self.lock = threading.Lock()
+
+
+default_pool = ConnectionPool()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=default_pool.forget)
+
+
+class KeepAliveFile:
+    " Puts the connection back in the pool once the response body is read "
+
+    def __init__(self, resp, conn, pool, key):
+        self.resp = resp
+        self.conn = conn
+        self.pool = pool
+        self.key = key
+
+    def release(self):
+        if self.conn is None:
+            return
+
+        if self.resp.isclosed() and not self.resp.will_close:
+            # body fully read, the connection can be used again
+            self.pool.put(self.key, self.conn)
+
+        else:
+            self.conn.close()
+
+        self.conn = None
+
+    def read(self, *args):
+        data = self.resp.read(*args)
+
+        if self.resp.isclosed():
+            self.release()
+
+        return data
+
+    def readline(self, *args):
+        line = self.resp.readline(*args)
+
+        if self.resp.isclosed():
+            self.release()
+
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def close(self):
+        if self.conn is not None and not self.resp.isclosed() and self.resp.length is not None and self.resp.length <= CHUNK_SIZE:
+            # small leftover (or empty body, e.g. 304), cheaper to drain it than to reconnect
+            try:
+                self.resp.read()
+
+            except (IOError, HTTPException):
+                pass
+
+        self.release()
+        self.resp.close()
+
+
+class PooledHandlerMixin:
+    " Keep-alive version of urllib's do_open, sharing connections via a ConnectionPool "
+
+    def pooled_open(self, http_class, req, **kwargs):
+        if getattr(req, '_tunnel_host', None):
+            # going through a proxy tunnel, leave it to urllib
+            return self.do_open(http_class, req, **kwargs)
+
+        key = (req.type, req.host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        if req.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+
+        else:
+            timeout = req.timeout
+
+        conn = self.pool.get(key)
+        reused = conn is not None
+
+        while True:
+            if conn is None:
+                conn = http_class(req.host, timeout=timeout, **kwargs)
+
+            else:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers,
+                             encode_chunked=req.has_header('Transfer-encoding'))
+                resp = conn.getresponse()
+
+            except ConnectionError as err:
+                conn.close()
+
+                if reused:
+                    # the server closed the idle connection in the meantime, retry with a fresh one
+                    conn = None
+                    reused = False
+                    continue
+
+                raise URLError(err)
+
+            except (OSError, HTTPException) as err:
+                conn.close()
+                raise URLError(err)
+
+            break
+
+        fp = KeepAliveFile(resp, conn, self.pool, key)
+        out = addinfourl(fp, resp.msg, req.get_full_url(), resp.status)
+        out.msg = resp.reason
+
+        return out
+
+
+class PooledHTTPHandler(PooledHandlerMixin, HTTPHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool or default_pool
+
+    def http_open(self, req):
+        return self.pooled_open(HTTPConnection, req)
+
+
+class PooledHTTPSHandler(PooledHandlerMixin, HTTPSHandler):
+    def __init__(self, pool=None, debuglevel=0, context=None):
+        HTTPSHandler.__init__(self, debuglevel, context)
+        self.pool = pool or default_pool
+
+    def https_open(self, req):
+        return self.pooled_open(HTTPSConnection, req, context=self._context)
@@ -32,6 +32,9 @@ try:
 except ImportError:
     TRAFILATURA_AVAILABLE = False
 
+# 提取算法的版本号；修改提取逻辑时需递增，使已缓存的提取结果失效（见 morss.ItemExtract）
+EXTRACTOR_VERSION = 1
+
 # trafilatura 提取结果的最短有效长度（字符数）；低于此值视为提取失败，回退到原有算法
 MIN_TRAFILATURA_RESULT_LENGTH = 200
 
@@ -0,0 +1,442 @@
+# This file is part of morss
+#
+# Copyright (C) 2013-2020 pictuga <contact@pictuga.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import codecs
+import re
+import sys
+import threading
+import zlib
+from cgi import parse_header
+from collections import OrderedDict
+from io import BytesIO, StringIO
+
+import chardet
+
+try:
+    # faster C implementation of chardet, if available
+    import cchardet as charset_detector
+except ImportError:
+    charset_detector = chardet
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    # python 2
+    from httplib import HTTPMessage
+    from urllib2 import BaseHandler, addinfourl
+    from urlparse import urlsplit
+except ImportError:
+    # python 3
+    from email import message_from_string
+    from http.client import HTTPMessage
+    from urllib.parse import urlsplit
+    from urllib.request import BaseHandler, addinfourl
+
+
+CHARSET_HINTS = 1000 # max number of websites to remember the encoding of
+
+
+class BodyResponse(addinfourl):
+    """ Response with its body already in memory (as `.data`). The detected
+    encoding & decoded body are kept, for all the handlers to share them """
+
+    truncated = False # body cut short on purpose, see SizeLimitHandler
+
+    def __init__(self, data, headers, url, code, msg=''):
+        addinfourl.__init__(self, BytesIO(data), headers, url, code)
+        self.msg = msg
+        self.data = data
+        self._encoding = None # (key, encoding)
+        self._text = None # (key, text, lossy)
+
+    @classmethod
+    def from_response(cls, resp, data=None):
+        " Copy of `resp`, with `data` as body (by default, the body of `resp`) "
+
+        if data is None:
+            data = resp.read()
+
+        return cls(data, resp.headers, resp.url, resp.code, resp.msg)
+
+    def _key(self):
+        # what detect_encoding looks at, besides the body, which doesn't change
+        return (self.headers.get('charset'), self.headers.get('content-type'))
+
+    def get_encoding(self):
+        key = self._key()
+
+        if self._encoding is None or self._encoding[0] != key:
+            self._encoding = (key, detect_encoding(self.data, self))
+
+        return self._encoding[1]
+
+    def get_text(self):
+        " Returns (encoding, decoded body) "
+
+        enc = self.get_encoding()
+        key = self._key()
+
+        if self._text is None or self._text[0] != key:
+            try:
+                self._text = (key, self.data.decode(enc), False)
+
+            except UnicodeDecodeError:
+                self._text = (key, self.data.decode(enc, 'replace'), True)
+
+        return enc, self._text[1]
+
+    def is_lossy(self):
+        " Whether the body has invalid sequences for its encoding "
+
+        self.get_text()
+        return self._text[2]
+
+
+class SizeLimitHandler(BaseHandler):
+    """ Limit file size, defaults to 5MiB. The body is read chunk by chunk and
+    decompressed on the fly, the limit applying to the decompressed size.
+    Reading stops early if a handler says it's seen enough (`data_enough`), the
+    response then being flagged as `truncated` (not to be cached) """
+
+    handler_order = 450
+    default_limit = 5*1024**2
+
+    def __init__(self, limit=default_limit):
+        self.limit = limit
+
+    def http_response(self, req, resp):
+        encoding = resp.headers.get('Content-Encoding', '').strip().lower()
+        decoder = get_decoder(encoding)
+
+        if isinstance(resp, BodyResponse):
+            if decoder is None and len(resp.data) <= self.limit:
+                # already in memory (cache, async), nothing to do
+                return resp
+
+            fp = BytesIO(resp.data)
+
+        else:
+            fp = resp
+
+        hooks = [x.data_enough for x in getattr(self.parent, 'handlers', []) if hasattr(x, 'data_enough')]
+        stopped = []
+
+        def enough(data):
+            if any(hook(req, resp, data) for hook in hooks):
+                stopped.append(True)
+                return True
+
+            return False
+
+        data = read_body(fp, self.limit, decoder, enough)
+
+        if fp is resp:
+            # hand the connection back (or close it) even if we stopped early
+            resp.close()
+
+        if decoder is not None:
+            del resp.headers['Content-Encoding']
+            resp.headers['Content-Encoding'] = 'identity'
+
+        out = BodyResponse.from_response(resp, data)
+        out.truncated = bool(stopped)
+
+        return out
+
+    https_response = http_response
+
+
+CHUNK_SIZE = 16*1024
+
+
+def read_body(fp, limit, decoder=None, enough=None):
+    """ Read (and decompress) up to `limit` bytes from `fp`, stopping earlier
+    if `enough(data)` returns True. Supports truncated compressed streams """
+
+    data = bytearray()
+
+    while len(data) < limit:
+        if decoder is not None and (decoder.unconsumed_tail or getattr(decoder, 'pending', False)):
+            # output was capped last time, don't read more compressed data
+            chunk = decoder.unconsumed_tail
+
+        else:
+            chunk = fp.read(CHUNK_SIZE if decoder is not None else min(CHUNK_SIZE, limit - len(data)))
+
+            if not chunk:
+                break
+
+        if decoder is not None:
+            try:
+                chunk = decoder.decompress(chunk, limit - len(data))
+
+            except DECODE_ERRORS:
+                # corrupted stream, keep what could be decoded
+                break
+
+        data += chunk
+
+        if enough is not None and enough(data):
+            break
+
+    return bytes(data)
+
+
+class DeflateDecoder:
+    """ "deflate" is supposed to be zlib-wrapped, but some servers send raw
+    deflate, so pick the right one based on the first bytes """
+
+    def __init__(self):
+        self.obj = None
+
+    @property
+    def unconsumed_tail(self):
+        return self.obj.unconsumed_tail if self.obj is not None else b''
+
+    def decompress(self, data, max_length=0):
+        if self.obj is None:
+            self.obj = zlib.decompressobj()
+
+            try:
+                return self.obj.decompress(data, max_length)
+
+            except zlib.error:
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        return self.obj.decompress(data, max_length)
+
+
+class BrotliDecoder:
+    """ zlib-like interface (with `max_length`) for brotli, the output being
+    capped as it's produced. `pending` means there's output left to get out
+    of the data already given, i.e. call again with no new data """
+
+    unconsumed_tail = b''
+
+    def __init__(self):
+        self.obj = brotli.Decompressor()
+
+    @property
+    def pending(self):
+        return not self.obj.can_accept_more_data()
+
+    def decompress(self, data, max_length=0):
+        if max_length:
+            # output can slightly exceed the limit (whole internal buffers)
+            return self.obj.process(data, output_buffer_limit=max_length)[:max_length]
+
+        return self.obj.process(data)
+
+
+class ZstdDecoder:
+    """ zlib-like interface (with `max_length`) for zstd. The decompressor has
+    no way to cap its output, so it's given the data a few bytes at a time,
+    each slice expanding to at most ZSTD_SLICE/4 blocks of 128KiB """
+
+    ZSTD_SLICE = 32
+    ZSTD_WINDOW = 8*1024**2 # max allowed in http (RFC 8878)
+
+    def __init__(self):
+        self.obj = zstandard.ZstdDecompressor(max_window_size=self.ZSTD_WINDOW).decompressobj()
+        self.unconsumed_tail = b''
+
+    def decompress(self, data, max_length=0):
+        out = bytearray()
+        i = 0
+
+        while i < len(data) and not (max_length and len(out) >= max_length):
+            out += self.obj.decompress(data[i:i+self.ZSTD_SLICE])
+            i += self.ZSTD_SLICE
+
+        self.unconsumed_tail = data[i:]
+
+        if max_length:
+            # beyond the limit anyway, no need to keep the rest
+            del out[max_length:]
+
+        return bytes(out)
+
+
+DECODERS = OrderedDict()
+DECODE_ERRORS = (zlib.error,)
+
+if brotli is not None and hasattr(brotli.Decompressor(), 'can_accept_more_data'):
+    # older brotli (and brotlicffi) can't cap their output, skip them
+    DECODERS['br'] = BrotliDecoder
+    DECODE_ERRORS += (brotli.error,)
+
+if zstandard is not None:
+    DECODERS['zstd'] = ZstdDecoder
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+DECODERS['gzip'] = lambda: zlib.decompressobj(zlib.MAX_WBITS | 32)
+DECODERS['x-gzip'] = DECODERS['gzip']
+DECODERS['deflate'] = DeflateDecoder
+
+ACCEPT_ENCODING = ', '.join(x for x in DECODERS if not x.startswith('x-'))
+
+
+def get_decoder(encoding):
+    " Streaming decompressor for the given Content-Encoding, None if not supported (or identity) "
+
+    if encoding in DECODERS:
+        return DECODERS[encoding]()
+
+    return None
+
+
+def detect_encoding(data, resp=None):
+    enc = detect_raw_encoding(data, resp)
+
+    # Normalize Chinese encodings to GBK for better compatibility
+    # GB2312 is a subset of GBK, and GB18030 is a superset of GBK
+    # Using GBK provides the best balance for decoding Chinese content
+    if enc.lower() in ('gb2312', 'gbk', 'gb18030'):
+        enc = 'gbk'
+
+    return enc
+
+
+def detect_raw_encoding(data, resp=None):
+    if resp is not None:
+        enc = resp.headers.get('charset')
+        if enc is not None:
+            return enc
+
+        enc = parse_header(resp.headers.get('content-type', ''))[1].get('charset')
+        if enc is not None:
+            return enc
+
+    match = re.search(b'charset=["\']?([0-9a-zA-Z-]+)', data[:1000])
+    if match:
+        return match.groups()[0].lower().decode()
+
+    match = re.search(b'encoding=["\']?([0-9a-zA-Z-]+)', data[:1000])
+    if match:
+        return match.groups()[0].lower().decode()
+
+    # fast path, most of the web is utf-8 (and ascii is a subset of it)
+    if is_utf8(data):
+        return 'utf-8'
+
+    # same encoding as the previous page of this website
+    host = get_host(resp)
+    enc = get_charset_hint(host)
+
+    if enc is not None:
+        try:
+            data.decode(enc)
+
+        except (UnicodeDecodeError, LookupError):
+            pass
+
+        else:
+            return enc
+
+    # Use a more representative sample for chardet: start + middle + end
+    # This helps detect encoding more accurately, especially for pages with
+    # mixed content or when encoding hints are at the beginning
+    if len(data) > 6000:
+        # Take samples from beginning, middle, and end
+        mid_start = max(0, len(data)//2 - 1000)
+        mid_end = len(data)//2 + 1000
+        sample = data[:2000] + data[mid_start:mid_end] + data[-2000:]
+    else:
+        sample = data
+    
+    enc = charset_detector.detect(sample)['encoding']
+    if enc and enc != 'ascii':
+        set_charset_hint(host, enc)
+        return enc
+
+    return 'utf-8'
+
+
+def is_utf8(data):
+    try:
+        # incremental decoder, not to choke on a truncated last character
+        codecs.getincrementaldecoder('utf-8')().decode(data, final=False)
+
+    except UnicodeDecodeError:
+        return False
+
+    else:
+        return True
+
+
+def get_host(resp=None):
+    url = getattr(resp, 'url', None)
+
+    if url:
+        return urlsplit(url).netloc
+
+    return None
+
+
+charset_hints = OrderedDict() # host -> last detected encoding
+charset_hints_lock = threading.Lock()
+
+
+def get_charset_hint(host):
+    if host is None:
+        return None
+
+    with charset_hints_lock:
+        enc = charset_hints.get(host)
+
+        if enc is not None:
+            charset_hints.move_to_end(host)
+
+        return enc
+
+
+def set_charset_hint(host, enc):
+    if host is None:
+        return
+
+    with charset_hints_lock:
+        charset_hints[host] = enc
+        charset_hints.move_to_end(host)
+
+        while len(charset_hints) > CHARSET_HINTS:
+            charset_hints.popitem(last=False)
+
+
+def parse_headers(text=u'\n\n'):
+    if sys.version_info[0] >= 3:
+        # python 3
+        return message_from_string(text, _class=HTTPMessage)
+
+    else:
+        # python 2
+        return HTTPMessage(StringIO(text))
+
+
+def error_response(code, msg, url=''):
+    # return an error as a response
+    return BodyResponse(b'', parse_headers(), url, code, msg)
@@ -0,0 +1,143 @@
+# This file is part of morss
+#
+# Copyright (C) 2013-2020 pictuga <contact@pictuga.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from lxml import etree
+
+from .util import data_path, pkg_path
+
+try:
+    # python 2
+    from ConfigParser import RawConfigParser
+except ImportError:
+    # python 3
+    from configparser import RawConfigParser
+
+try:
+    # python 3
+    from types import MappingProxyType
+except ImportError:
+    # python 2
+    MappingProxyType = dict
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+
+    except OSError:
+        return None
+
+
+def load_rules(filename):
+    " Read the rulesets from disk, returns them along with the files they depend on "
+
+    config = RawConfigParser()
+    config.read(filename)
+
+    rules = dict([(x, dict(config.items(x))) for x in config.sections()])
+    files = [filename]
+
+    for section in rules.keys():
+        # for each ruleset
+
+        for arg in rules[section].keys():
+            # for each rule
+
+            if rules[section][arg].startswith('file:'):
+                path = data_path('www', rules[section][arg][5:])
+                file_raw = open(path).read()
+                file_clean = re.sub('<[/?]?(xsl|xml)[^>]+?>', '', file_raw)
+                rules[section][arg] = file_clean
+                files.append(path)
+
+            elif '\n' in rules[section][arg]:
+                rules[section][arg] = tuple(rules[section][arg].split('\n')[1:])
+
+        rules[section] = MappingProxyType(rules[section])
+
+    return MappingProxyType(rules), files
+
+
+rules_registry = {} # filename -> (rulesets, [(path, mtime), ...])
+rules_lock = threading.Lock()
+
+
+def parse_rules(filename=None):
+    " Shared read-only rulesets, only reloaded when one of their files changed "
+
+    if not filename:
+        filename = pkg_path('feedify.ini')
+
+    entry = rules_registry.get(filename)
+
+    if entry is not None and all(get_mtime(path) == mtime for (path, mtime) in entry[1]):
+        return entry[0]
+
+    with rules_lock:
+        entry = rules_registry.get(filename)
+
+        if entry is not None and all(get_mtime(path) == mtime for (path, mtime) in entry[1]):
+            # another thread just reloaded them
+            return entry[0]
+
+        mtimes = [(filename, get_mtime(filename))]
+        rules, files = load_rules(filename)
+        mtimes += [(path, get_mtime(path)) for path in files[1:]]
+
+        rules_registry[filename] = (rules, mtimes)
+
+        return rules
+
+
+XPATH_CACHE = 1000 # max number of compiled xpath rules to keep around
+
+xpath_cache = OrderedDict() # (rule, namespaces, mode) -> etree.XPath
+xpath_cache_lock = threading.Lock()
+
+
+def compile_xpath(rule, namespaces=None, mode='xml'):
+    " Compiled (and cached) version of a rule, raises etree.XPathError on invalid rules "
+
+    key = (rule, tuple(sorted(namespaces.items())) if namespaces else None, mode)
+
+    with xpath_cache_lock:
+        xpath = xpath_cache.get(key)
+
+        if xpath is not None:
+            xpath_cache.move_to_end(key)
+            return xpath
+
+    if mode == 'html':
+        # do proper "class" matching (too "heavy" to type as-it in rules)
+        pattern = r'\[class=([^\]]+)\]'
+        repl = r'[@class and contains(concat(" ", normalize-space(@class), " "), " \1 ")]'
+        rule = re.sub(pattern, repl, rule)
+
+    xpath = etree.XPath(rule, namespaces=namespaces)
+
+    with xpath_cache_lock:
+        xpath_cache[key] = xpath
+
+        while len(xpath_cache) > XPATH_CACHE:
+            xpath_cache.popitem(last=False)
+
+    return xpath
@@ -20,6 +20,17 @@ import os.path
 import sys
 
 
+def log(txt):
+    if 'DEBUG' in os.environ:
+        if 'REQUEST_URI' in os.environ:
+            # when running on Apache
+            open('morss.log', 'a').write("%s\n" % repr(txt))
+
+        else:
+            # when using internal server or cli
+            print(repr(txt), file=sys.stderr)
+
+
 def pkg_path(*path_elements):
     return os.path.join(os.path.dirname(__file__), *path_elements)
 
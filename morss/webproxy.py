@@ -0,0 +1,155 @@
+# This file is part of morss
+#
+# Copyright (C) 2013-2020 pictuga <contact@pictuga.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from .util import log
+
+try:
+    # python 2
+    from urlparse import urlparse
+except ImportError:
+    # python 3
+    from urllib.parse import urlparse
+
+
+def extract_target_from_proxy(web_proxy):
+    """
+    Extract the target base URL from a web proxy URL.
+    
+    Args:
+        web_proxy: The web proxy prefix URL (e.g., 'https://proxy.com/https/target.com')
+    
+    Returns:
+        The target base URL (e.g., 'https://target.com') or None if not found
+    
+    Examples:
+        'https://proxy.saha.qzz.io/https/www.target.com' -> 'https://www.target.com'
+        'https://sitedl.westpan.me/123/https/t66y.com' -> 'https://t66y.com'
+        'https://proxy.com/view/http://target.com' -> 'http://target.com'
+    """
+    # Remove trailing slash
+    web_proxy = web_proxy.rstrip('/')
+    
+    # Try to find embedded URL in two patterns:
+    # Pattern 1: .../http://domain or .../https://domain (full URL with :// in path)
+    # Pattern 2: .../http/domain or .../https/domain (protocol and domain separated)
+    
+    # Look for http:// or https:// in the path (after the proxy domain)
+    # Search for last occurrence of /http:// or /https://
+    MIN_SCHEME_LENGTH = len('http://')  # Minimum length for a valid URL scheme
+    for protocol in ['https://', 'http://']:
+        search_str = '/' + protocol
+        idx = web_proxy.rfind(search_str)
+        if idx != -1 and idx > MIN_SCHEME_LENGTH:  # Make sure it's not the beginning of the URL
+            # Extract the embedded URL
+            return web_proxy[idx + 1:]
+    
+    # Pattern 2: Protocol and domain separated by slashes
+    # Split the proxy URL by '/'
+    parts = web_proxy.split('/')
+    
+    # Look for protocol indicators (http or https) in the path
+    # Format: https://proxy.domain/{arbitrary_path}/{protocol}/{target.domain}
+    for i, part in enumerate(parts[3:], start=3):  # Start after scheme and domain
+        if part in ('http', 'https'):
+            # Found protocol indicator, next part should be the target domain
+            if i + 1 < len(parts):
+                target_protocol = part
+                target_domain = parts[i + 1]
+                return f"{target_protocol}://{target_domain}"
+    
+    return None
+
+
+def web_proxy_join(web_proxy, relative_link):
+    """
+    Concatenate web_proxy prefix with relative link, handling double slashes.
+    
+    Args:
+        web_proxy: The web proxy prefix URL (e.g., 'https://proxy.com/view/http/target.com')
+        relative_link: The relative link extracted from the page (e.g., '/foo/bar.html')
+    
+    Returns:
+        The concatenated URL with proper slash handling
+    """
+    # Remove trailing slash from proxy if present
+    web_proxy = web_proxy.rstrip('/')
+    
+    # Ensure relative_link starts with a slash
+    if not relative_link.startswith('/'):
+        relative_link = '/' + relative_link
+    
+    # Concatenate
+    return web_proxy + relative_link
+
+
+def convert_absolute_url_to_proxy(web_proxy, absolute_url):
+    """
+    Convert an absolute URL to use the web proxy format.
+    
+    Args:
+        web_proxy: The web proxy prefix URL (e.g., 'https://proxy.com/view/http/target.com')
+        absolute_url: The absolute URL to convert (e.g., 'https://example.com/page')
+    
+    Returns:
+        The proxied URL
+    
+    Examples:
+        web_proxy='https://proxy.com/view/http/target.com'  (Pattern 2)
+        absolute_url='https://example.com/page'
+        
+        Returns: 'https://proxy.com/view/https/example.com/page'
+        
+        Supports both Pattern 1 (http://domain) and Pattern 2 (http/domain) proxy formats.
+    """
+    # Parse the web_proxy to understand its format
+    # Try to detect if it uses pattern 1 (embedded ://) or pattern 2 (protocol/domain)
+    
+    # Minimum length to ensure we're not matching the proxy's own protocol
+    MIN_PROTOCOL_LENGTH = len('http://')
+    
+    # First, check if web_proxy contains embedded URL with ://
+    if '/http://' in web_proxy or '/https://' in web_proxy:
+        # Pattern 1: embedded URL format (e.g., 'https://proxy.com/view/http://target.com')
+        # Extract the proxy base (everything before the last embedded URL)
+        # Use rfind to get the last occurrence, which should be the target URL
+        for protocol in ['https://', 'http://']:
+            search_str = '/' + protocol
+            idx = web_proxy.rfind(search_str)
+            # Verify this is after the proxy's own protocol (at least MIN_PROTOCOL_LENGTH chars in)
+            if idx != -1 and idx > MIN_PROTOCOL_LENGTH:
+                proxy_base = web_proxy[:idx]
+                # Construct new proxied URL by appending the absolute URL
+                return proxy_base + '/' + absolute_url
+    
+    # Pattern 2: protocol/domain format (e.g., 'https://proxy.com/123/https/target.com')
+    parts = web_proxy.split('/')
+    for i, part in enumerate(parts[3:], start=3):
+        if part in ('http', 'https'):
+            # Found protocol separator, proxy base is everything before it
+            proxy_base = '/'.join(parts[:i])
+            # Parse the absolute URL to get protocol and rest
+            parsed = urlparse(absolute_url)
+            protocol = parsed.scheme  # 'http' or 'https'
+            # domain and path combined - remove the scheme and '://'
+            domain_and_path = absolute_url[len(parsed.scheme + '://'):]
+            # Construct new proxied URL
+            return proxy_base + '/' + protocol + '/' + domain_and_path
+    
+    # Fallback: if we can't determine the pattern, return the original URL
+    # This is safer than trying string replacement which could fail
+    log(f'Unable to determine proxy pattern for {web_proxy}, returning original URL {absolute_url}')
+    return absolute_url
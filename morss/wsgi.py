@@ -16,6 +16,7 @@
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import cgitb
+import hashlib
 import mimetypes
 import os.path
 import re
@@ -127,10 +128,37 @@ def cgi_app(environ, start_response):
     # get the work done
     url, rss = FeedFetch(url, options)
 
-    start_response(headers['status'], list(headers.items()))
+    # same feed & options as earlier? use the previous output
+    key = output_key(url, options, rss.validator)
+    etag = '"%s"' % key
+    out = None
+
+    if DELAY > 0 and not options.force:
+        try:
+            out = caching.default_cache['output:' + key]
+
+        except KeyError:
+            pass
+
+    if out is not None:
+        headers['etag'] = etag
+
+        if etag in parse_etags(environ.get('HTTP_IF_NONE_MATCH', '')):
+            headers['status'] = '304 Not Modified'
+            start_response(headers['status'], list(headers.items()))
+            return []
+
+    else:
+        rss = FeedGather(rss, url, options)
+        out = FeedFormat(rss, options)
+
+        if DELAY > 0 and rss.complete:
+            # not when some articles are missing, for lack of time
+            out = out if isinstance(out, bytes) else out.encode('utf-8')
+            caching.default_cache.set('output:' + key, out, DELAY)
+            headers['etag'] = etag
 
-    rss = FeedGather(rss, url, options)
-    out = FeedFormat(rss, options)
+    start_response(headers['status'], list(headers.items()))
 
     if options.silent:
         return ['']
@@ -139,6 +167,20 @@ def cgi_app(environ, start_response):
         return [out]
 
 
+def output_key(url, options, validator):
+    " Identifies a given output: the feed url & version (e.g. ETag) and the options "
+
+    raw = repr((url, validator, sorted((str(k), str(v)) for (k, v) in options.options.items())))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def parse_etags(value):
+    " Parses If-None-Match, weak ETags being fine for our use "
+
+    etags = [x.strip() for x in value.split(',')]
+    return [x[2:] if x.startswith('W/') else x for x in etags]
+
+
 def middleware(func):
     " Decorator to turn a function into a wsgi middleware "
     # This is called when parsing the "@middleware" code
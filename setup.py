@@ -44,7 +44,7 @@ setup(
     packages = [package_name],
     install_requires = ['lxml', 'bs4', 'python-dateutil', 'chardet'],
     extras_require = {
-        'full': ['redis', 'diskcache', 'gunicorn', 'setproctitle'],
+        'full': ['redis', 'diskcache', 'gunicorn', 'setproctitle', 'brotli', 'zstandard'],
         'dev': ['pylint', 'pyenchant', 'pytest', 'pytest-cov'],
     },
     python_requires = '>=2.7',
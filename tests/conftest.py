@@ -11,7 +11,7 @@ try:
 except:
     # python3
     from http.server import (BaseHTTPRequestHandler, HTTPServer,
-                             SimpleHTTPRequestHandler)
+                             SimpleHTTPRequestHandler, ThreadingHTTPServer)
 
 class HTTPReplayHandler(SimpleHTTPRequestHandler):
     " Serves pages saved alongside with headers. See `curl --http1.1 -is http://...` "
@@ -55,6 +55,40 @@ def replay_server():
     httpd.shutdown()
     thread.join()
 
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    " HTTP/1.1 server, counting the connections it gets "
+
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        KeepAliveHandler.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', '7')
+        self.end_headers()
+        self.wfile.write(b'success')
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def keepalive_server():
+    KeepAliveHandler.connections = 0
+    httpd = ThreadingHTTPServer(('', 8889), KeepAliveHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+
+    yield KeepAliveHandler
+
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
 if __name__ == '__main__':
     httpd = make_server()
     httpd.serve_forever()
@@ -0,0 +1,162 @@
+import threading
+import time
+
+import pytest
+
+from morss.caching import (CacheMaintenance, CappedDict, CappedStripe,
+                           PrefetchedCache, TieredCache)
+
+
+def test_capped_dict_lru():
+    cache = CappedDict(max_items=2, max_bytes=0)
+    cache.stripes = [CappedStripe(2, 0)] # to know which one gets evicted
+
+    cache['a'] = b'1'
+    cache['b'] = b'2'
+    cache['a']
+    cache['c'] = b'3'
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.stats()['evictions'] == 1
+
+
+def test_capped_dict_bytes():
+    cache = CappedDict(max_items=0, max_bytes=16*1000)
+
+    for i in range(1000):
+        cache[str(i)] = b'x' * 100
+
+    assert cache.stats()['bytes'] <= 16*1000
+    assert 0 < len(cache) < 1000
+
+
+def test_capped_dict_ttl():
+    cache = CappedDict()
+    cache.set('a', b'1', ttl=0.1)
+    assert cache['a'] == b'1'
+
+    time.sleep(0.2)
+    assert 'a' not in cache
+    assert cache.stats()['hits'] == 1
+
+
+def test_capped_dict_threads():
+    cache = CappedDict(max_items=100, max_bytes=0)
+
+    def run(n):
+        for i in range(1000):
+            cache['%s-%s' % (n, i)] = b'x'
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert len(cache) <= 100
+
+
+def test_get_many():
+    cache = CappedDict()
+    cache['a'] = b'1'
+    cache['b'] = b'2'
+
+    assert cache.get_many(['a', 'b', 'c']) == {'a': b'1', 'b': b'2'}
+
+
+def test_prefetched_cache():
+    cache = CappedDict()
+    cache['a'] = b'1'
+
+    view = PrefetchedCache(cache, ['a', 'b'])
+    hits = cache.stats()['hits']
+
+    assert view['a'] == b'1'
+    assert 'b' not in view
+    assert cache.stats()['hits'] == hits
+
+    view['b'] = b'2'
+    assert view['b'] == b'2'
+    assert cache['b'] == b'2'
+
+
+def test_tiered_cache():
+    l2 = CappedDict()
+    l2['a'] = b'1'
+    cache = TieredCache(CappedDict(), l2, 60)
+
+    assert cache['a'] == b'1'
+    assert cache['a'] == b'1'
+    assert 'b' not in cache
+    assert 'b' not in cache
+
+    cache['b'] = b'2'
+    assert l2['b'] == b'2'
+    assert cache['b'] == b'2'
+
+    stats = cache.stats()
+    assert (stats['l1_hits'], stats['l1_negative_hits'], stats['l2_hits'], stats['l2_misses']) == (2, 1, 1, 1)
+
+
+def test_diskcache_limits(tmp_path):
+    pytest.importorskip('diskcache')
+
+    from morss.caching import DiskCacheHandler
+
+    for shards in (1, 4):
+        cache = DiskCacheHandler(str(tmp_path / str(shards)), shards=shards, max_items=10)
+
+        for i in range(30):
+            cache[str(i)] = b'x'
+
+        assert cache.get_many(['1', 'x']) == {'1': b'x'}
+
+        cache.trim()
+        assert len(cache.cache) == 10
+
+
+def test_maintenance():
+    cache = CappedDict()
+    cache.set('a', b'1', ttl=0.1)
+
+    maintenance = CacheMaintenance()
+    maintenance.register(cache, 0.2)
+
+    time.sleep(0.5)
+    maintenance.stop()
+
+    assert len(cache) == 0
+    assert maintenance.stats()['passes'] >= 2
+    assert maintenance.thread is None
+
+
+def test_capped_dict_trim_deadline():
+    cache = CappedDict()
+    cache.set('a', b'1', ttl=0.01)
+    time.sleep(0.02)
+
+    cache.trim(deadline=0) # already late, nothing done
+    assert cache.stats()['items'] == 1
+
+    cache.trim()
+    assert cache.stats()['items'] == 0
+
+
+def test_diskcache_trim_deadline(tmp_path):
+    pytest.importorskip('diskcache')
+
+    from morss.caching import DiskCacheHandler
+
+    for shards in (1, 4):
+        cache = DiskCacheHandler(str(tmp_path / str(shards)), shards=shards, max_items=100, cull_limit=0)
+
+        for i in range(1000):
+            cache.set(str(i), b'x', ttl=0.01)
+
+        time.sleep(0.1)
+
+        # no time left, nothing done
+        cache.trim(time.time() - 1)
+        assert len(cache.cache) == 1000
+
+        cache.trim(time.time() + 60)
+        assert len(cache.cache) == 0
@@ -1,5 +1,10 @@
+import asyncio
+import time
+from urllib.error import URLError
+
 import pytest
 
+from morss.caching import CappedDict
 from morss.crawler import *
 
 
@@ -62,3 +67,303 @@ def test_http_all_redirect_handler(replay_server, opener):
 @pytest.mark.parametrize('opener', [custom_opener(), build_opener(HTTPRefreshHandler())])
 def test_http_refresh_handler(replay_server, opener):
     assert opener.open('http://localhost:8888/header-refresh.txt').geturl() == 'http://localhost:8888/200-ok.txt'
+
+def test_pooled_handler(keepalive_server):
+    pool = ConnectionPool()
+    opener = build_opener(PooledHTTPHandler(pool))
+
+    for i in range(3):
+        assert opener.open('http://localhost:8889/').read() == b'success'
+
+    pool.clear()
+    assert keepalive_server.connections == 1
+
+def test_pooled_handler_partial_read(keepalive_server):
+    pool = ConnectionPool()
+    opener = build_opener(PooledHTTPHandler(pool), SizeLimitHandler(3))
+
+    for i in range(3):
+        assert opener.open('http://localhost:8889/').read() == b'suc'
+
+    pool.clear()
+    assert keepalive_server.connections == 1
+
+@pytest.mark.parametrize('url,data', [
+    ('200-ok.txt', b'success\r\n'),
+    ('gzip.txt', b'success\n'),
+    ('301-redirect-rel.txt', b'success\r\n'),
+    ('meta-redirect-abs.txt', b'success\r\n'),
+    ])
+def test_adv_get_async(replay_server, url, data):
+    out = asyncio.run(adv_get_async('http://localhost:8888/%s' % url, policy='refresh'))
+    assert out['data'] == data
+    assert out['url'] == 'http://localhost:8888/%s' % (url if url == 'gzip.txt' else '200-ok.txt')
+
+def test_adv_get_async_alternate(replay_server):
+    out = asyncio.run(adv_get_async('http://localhost:8888/alternate-abs.txt', follow='rss', policy='refresh'))
+    assert out['url'] == 'http://localhost:8888/200-ok.txt'
+
+def test_single_decode(replay_server, monkeypatch):
+    import morss.responses
+
+    calls = []
+    detect = morss.responses.detect_encoding
+    monkeypatch.setattr(morss.responses, 'detect_encoding', lambda *a: calls.append(a) or detect(*a))
+
+    out = adv_get('http://localhost:8888/enc-gbk-meta.txt', follow='rss', policy='refresh')
+    assert out['encoding'] == 'gbk'
+    assert len(calls) == 1
+
+def test_charset_hint(replay_server, monkeypatch):
+    import morss.responses
+
+    url = 'http://localhost:8888/enc-iso-8859-1-missing.txt'
+    assert adv_get(url, policy='refresh')['encoding'].lower() in ('windows-1252', 'iso-8859-1')
+
+    monkeypatch.setattr(morss.responses.charset_detector, 'detect', None)
+    assert adv_get(url, policy='refresh')['encoding'].lower() in ('windows-1252', 'iso-8859-1')
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate'])
+def test_read_body_decompressed_limit(encoding):
+    import zlib
+
+    raw = zlib.compress(b'0' * 10*1024**2)
+    if encoding == 'gzip':
+        obj = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        raw = obj.compress(b'0' * 10*1024**2) + obj.flush()
+
+    data = read_body(BytesIO(raw), 1000, get_decoder(encoding))
+    assert data == b'0' * 1000
+
+
+@pytest.mark.parametrize('encoding', ['br', 'zstd'])
+def test_read_body_bomb(encoding):
+    import tracemalloc
+
+    if encoding == 'br':
+        brotli = pytest.importorskip('brotli')
+        raw = brotli.compress(b'0' * 100*1024**2)
+
+    else:
+        zstandard = pytest.importorskip('zstandard')
+        raw = zstandard.ZstdCompressor(level=19).compress(b'0' * 100*1024**2)
+
+    tracemalloc.start()
+
+    try:
+        data = read_body(BytesIO(raw), 500*1024, get_decoder(encoding))
+        peak = tracemalloc.get_traced_memory()[1]
+
+    finally:
+        tracemalloc.stop()
+
+    assert data == b'0' * 500*1024
+    assert peak < 10*1024**2
+
+
+def test_read_body_enough():
+    data = read_body(BytesIO(b'x' * 100000), 500*1024, enough=lambda data: len(data) >= 10000)
+    assert 10000 <= len(data) < 100000
+
+@pytest.mark.parametrize('encoding', ['br', 'zstd'])
+def test_decoders(encoding):
+    if encoding == 'br':
+        brotli = pytest.importorskip('brotli')
+        raw = brotli.compress(b'success' * 1000)
+
+    else:
+        zstandard = pytest.importorskip('zstandard')
+        raw = zstandard.ZstdCompressor().compress(b'success' * 1000)
+
+    assert encoding in ACCEPT_ENCODING
+    assert read_body(BytesIO(raw), 500*1024, get_decoder(encoding)) == b'success' * 1000
+    assert read_body(BytesIO(raw), 100, get_decoder(encoding)) == (b'success' * 1000)[:100]
+
+def test_single_flight():
+    import threading
+    import time
+
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def func(x):
+        calls.append(x)
+        time.sleep(0.2)
+        return x
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', func, 'value'))) for i in range(5)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert calls == ['value']
+    assert results == ['value'] * 5
+    assert flight.calls == {}
+
+def make_cache_entry(data, age):
+    return {'code': 200, 'msg': 'OK', 'headers': parse_headers('Content-Type: text/plain\n\n'), 'data': data, 'timestamp': time.time() - age}
+
+
+def test_stale_while_revalidate(replay_server):
+    import morss.httpcache
+
+    url = 'http://localhost:8888/200-ok.txt'
+    handler = CacheHandler(cache=CappedDict(), force_max=60, stale_while_revalidate=60)
+    handler.save(url, make_cache_entry(b'old', 90))
+
+    assert build_opener(handler).open(url).read() == b'old'
+
+    while morss.httpcache.revalidating:
+        time.sleep(0.1)
+
+    assert handler.load(url)['data'] == b'success\r\n'
+
+
+def test_stale_if_error():
+    url = 'http://localhost:1/error'
+    cache = CappedDict()
+    handler = CacheHandler(cache=cache)
+    handler.save(url, make_cache_entry(b'old', 90))
+
+    assert adv_get(url, force_max=60, stale_if_error=60, cache=cache)['data'] == b'old'
+    assert asyncio.run(adv_get_async(url, force_max=60, stale_if_error=60, cache=cache))['data'] == b'old'
+
+    handler.save(url, make_cache_entry(b'old', 150))
+
+    with pytest.raises(URLError):
+        adv_get(url, force_max=60, stale_if_error=60, cache=cache)
+
+@pytest.mark.parametrize('size', [10, 10000])
+def test_cache_entry(size):
+    entry = make_cache_entry(b'x' * size, 0)
+    entry['headers'] = 'Content-Type: text/plain\nETag: "abc"\nX-Useless: 1\n\n'
+    raw = encode_entry(entry)
+
+    assert len(raw) < size + 100
+
+    data = decode_entry(raw)
+    assert data['code'] == 200
+    assert data['data'] == b'x' * size
+    assert data['headers']['etag'] == '"abc"'
+    assert 'x-useless' not in data['headers']
+
+
+def test_cache_entry_without_zstd(replay_server, monkeypatch):
+    import morss.httpcache
+
+    pytest.importorskip('zstandard')
+
+    url = 'http://localhost:8888/200-ok.txt'
+    cache = CappedDict()
+    CacheHandler(cache=cache).save(url, make_cache_entry(b'x' * 10000, 0))
+
+    # e.g. a process without zstandard sharing the same redis
+    monkeypatch.setattr(morss.httpcache, 'zstandard', None)
+
+    with pytest.raises(KeyError):
+        decode_entry(cache[url])
+
+    handler = CacheHandler(cache=cache, force_min=60)
+    assert handler.load(url) is None
+    assert build_opener(handler).open(url).read() != b'x' * 10000
+
+
+def test_cache_entry_pickle():
+    import pickle
+
+    entry = make_cache_entry(b'old', 0)
+    entry['headers'] = str(entry['headers'])
+    data = decode_entry(pickle.dumps(entry, 0))
+    assert data['data'] == b'old'
+    assert data['headers']['content-type'] == 'text/plain'
+
+def test_cache_backend_calls(replay_server):
+    url = 'http://localhost:8888/200-ok.txt'
+    cache = CappedDict()
+    build_opener(CacheHandler(cache=cache)).open(url)
+
+    before = CacheHandler.backend_calls
+    build_opener(CacheHandler(cache=cache, policy='cached')).open(url)
+    assert CacheHandler.backend_calls - before == 1
+
+    # answered by the prefetched view, no round-trip
+    from morss.caching import PrefetchedCache
+
+    prefetched = PrefetchedCache(cache, [url])
+    before = CacheHandler.backend_calls
+    build_opener(CacheHandler(cache=prefetched, policy='cached')).open(url)
+    assert CacheHandler.backend_calls - before == 0
+
+def test_cache_alternate_truncated(replay_server):
+    url = 'http://localhost:8888/alternate-long.txt'
+    cache = CappedDict()
+
+    # stops reading once the alternate link is found
+    assert custom_opener(follow='rss', cache=cache).open(url).geturl() == 'http://localhost:8888/200-ok.txt'
+
+    data = custom_opener(cache=cache, policy='cached').open(url).read()
+    assert data.endswith(b'</html>\n')
+
+def test_cache_entry_ttl():
+    import morss.caching
+
+    entry = make_cache_entry(b'data', 0)
+    entry['headers'] = parse_headers('Cache-Control: max-age=999999999\n\n')
+    assert CacheHandler(cache=CappedDict()).entry_ttl(entry) == 999999999
+
+    entry = make_cache_entry(b'data', 0)
+    assert CacheHandler(cache=CappedDict(), force_max=60).entry_ttl(entry) == morss.caching.CACHE_TTL
+
+def test_cache_lock(replay_server, monkeypatch):
+    import contextlib
+
+    import morss.caching
+
+    url = 'http://localhost:8888/200-ok.txt'
+    locks = []
+
+    class LockedCache(CappedDict):
+        @contextlib.contextmanager
+        def lock(self, key, timeout):
+            locks.append(key)
+
+            if key == url + '?other':
+                # another process fetched it while we were waiting
+                handler.save(key, make_cache_entry(b'from elsewhere', 0))
+
+            yield
+
+    monkeypatch.setattr(morss.caching, 'CACHE_LOCK', 10)
+    handler = CacheHandler(cache=LockedCache(), force_min=60)
+
+    # fresh cache, no lock
+    handler.save(url, make_cache_entry(b'cached', 0))
+    assert build_opener(handler).open(url).read() == b'cached'
+    assert locks == []
+
+    # going online
+    assert build_opener(handler).open(url + '?new').read() != b'cached'
+    assert locks == [url + '?new']
+    assert handler.held == {}
+
+    # using what was fetched while waiting for the lock
+    assert build_opener(handler).open(url + '?other').read() == b'from elsewhere'
+    assert handler.held == {}
+
+def test_adv_get_async_slow_cache(replay_server):
+    class SlowCache(CappedDict):
+        def __getitem__(self, key):
+            time.sleep(0.3)
+            return super().__getitem__(key)
+
+    async def fetch_all(urls):
+        cache = SlowCache()
+        return await asyncio.gather(*[adv_get_async(url, policy='refresh', cache=cache) for url in urls])
+
+    urls = ['http://localhost:8888/200-ok.txt?%s' % i for i in range(4)]
+
+    start = time.time()
+    asyncio.run(fetch_all(urls))
+
+    # the cache lookups didn't block the event loop, i.e. weren't run one after the other
+    assert time.time() - start < 1
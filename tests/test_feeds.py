@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 from morss.crawler import adv_get
@@ -57,13 +59,27 @@ def check_add(feed):
     assert '!ITEM_DESC3!' in feed[1].desc
     assert '!ITEM_CONTENT3!' in feed[1].content
 
+def check_remove(feed):
+    count = len(feed)
+    assert feed[0] is feed[0]
+
+    feed.append({'title': '!ITEM_TITLE3!'})
+    assert len(feed) == count + 1
+    assert feed[count].title == '!ITEM_TITLE3!'
+
+    feed[count].remove()
+    assert len(feed) == count
+
+    del feed[0]
+    assert len(feed) == count - 1
+
 each_format = pytest.mark.parametrize('url', [
     'feed-rss-channel-utf-8.txt', 'feed-atom-utf-8.txt',
     'feed-atom03-utf-8.txt', 'feed-json-utf-8.txt', 'feed-html-utf-8.txt',
     ])
 
 each_check = pytest.mark.parametrize('check', [
-    check_feed, check_output, check_change, check_add,
+    check_feed, check_output, check_change, check_add, check_remove,
     ])
 
 @each_format
@@ -106,3 +122,95 @@ def test_convert_csv(replay_server, url):
     assert '!ITEM_LINK!' in output
     assert '!ITEM_DESC!' in output
     assert '!ITEM_CONTENT!' in output
+
+def test_parse_rules(tmp_path):
+    rules = parse_rules()
+    assert parse_rules() is rules
+
+    with pytest.raises(TypeError):
+        rules['rss-channel']['items'] = '//foo'
+
+    ini = tmp_path / 'rules.ini'
+    ini.write_text('[test]\nitems = //item\npath =\n\thttp://a/*\n\thttp://b/*\n')
+
+    rules = parse_rules(str(ini))
+    assert rules['test']['items'] == '//item'
+    assert rules['test']['path'] == ('http://a/*', 'http://b/*')
+    assert parse_rules(str(ini)) is rules
+
+    ini.write_text('[test]\nitems = //entry\n')
+    os.utime(str(ini), (0, 0))
+
+    assert parse_rules(str(ini))['test']['items'] == '//entry'
+
+def test_compile_xpath():
+    xpath = compile_xpath('//item', {'atom': 'http://www.w3.org/2005/Atom'})
+    assert compile_xpath('//item', {'atom': 'http://www.w3.org/2005/Atom'}) is xpath
+    assert compile_xpath('//item', None, 'html') is not xpath
+
+    html = compile_xpath('//div[class=foo]', None, 'html')
+    root = etree.fromstring('<html><div class="bar foo">a</div><div class="foobar">b</div></html>')
+    assert [x.text for x in html(root)] == ['a']
+
+    with pytest.raises(etree.XPathError):
+        compile_xpath('//[')
+
+def test_item_field_cache(replay_server):
+    feed = get_feed('feed-rss-channel-utf-8.txt')
+    item = feed[0]
+
+    assert item.title == '!ITEM_TITLE!'
+    item.rule_set(item.rules['item_title'], 'behind the cache')
+    assert item.title == '!ITEM_TITLE!'
+
+    item.title = '!ITEM_TITLE2!'
+    assert item.title == '!ITEM_TITLE2!'
+
+    del item.title
+    assert item.title is None
+
+    item.field_cache = False
+    item.rule_set(item.rules['item_link'], '!ITEM_LINK2!')
+    assert item.link == '!ITEM_LINK2!'
+
+def make_stream_feed(count):
+    items = ''.join('<item><title>%s</title><pubDate>Mon, %02d Jan 2024 00:00:00 GMT</pubDate></item>' % (i, (i * 7) % count + 1) for i in range(count))
+    return ('<?xml version="1.0"?><rss version="2.0"><channel><title>!TITLE!</title>%s</channel></rss>' % items).encode()
+
+@pytest.mark.parametrize('order,titles', [
+    ('first', ['0', '1']), (None, ['0', '1']), ('last', ['3', '4']),
+    ('newest', ['2', '4']), ('oldest', ['0', '3']),
+    ])
+def test_parse_stream(order, titles):
+    # days: 1, 3, 5, 2, 4
+    feed = parse(make_stream_feed(5), max_items=2, order=order)
+
+    assert feed.title == '!TITLE!'
+    assert [item.title for item in feed] == titles
+
+def test_parse_stream_large():
+    data = make_stream_feed(5000)
+    feed = FeedXML(data, max_items=3)
+
+    assert [item.title for item in feed] == ['0', '1', '2']
+    assert feed.title == '!TITLE!'
+    assert feed.tostring().count('<item>') == 3
+
+def test_parse_stream_metadata_after_items():
+    items = ''.join('<item><title>%s</title></item>' % i for i in range(500))
+    data = ('<?xml version="1.0"?><rss version="2.0"><channel>%s<title>!TITLE!</title><description>!DESC!</description></channel></rss>' % items).encode()
+
+    feed = parse(data, max_items=10)
+
+    assert feed.title == '!TITLE!'
+    assert feed.desc == '!DESC!'
+    assert len(feed) == 10
+
+@each_format
+def test_parse_stream_formats(replay_server, url):
+    url = 'http://localhost:8888/%s' % url
+    out = adv_get(url)
+    feed = parse(out['data'], url=url, encoding=out['encoding'], max_items=1)
+
+    check_feed(feed)
+    assert len(feed) >= 1
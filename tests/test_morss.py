@@ -0,0 +1,204 @@
+import asyncio
+import time
+from urllib.error import HTTPError
+
+import pytest
+
+from morss import morss, readabilite
+from morss.caching import CappedDict
+from morss.feeds import FeedXML
+from morss.morss import (FeedGather, FeedGatherAsync, HostQueue, ItemExtract,
+                         Options)
+
+
+def make_feed(links):
+    feed = FeedXML()
+
+    for link in links:
+        feed.append({'title': link, 'link': link})
+
+    return feed
+
+
+@pytest.fixture
+def fake_fetch(monkeypatch):
+    calls = []
+
+    def fetch(link, options, fast=False, cache=None):
+        calls.append((link, fast))
+
+        if fast:
+            return {'content': 'cached ' + link, 'main_image': None, 'url': link}
+
+        time.sleep(float(link.rsplit('/', 1)[-1]))
+        return {'content': 'fetched ' + link, 'main_image': None, 'url': link}
+
+    monkeypatch.setattr(morss, 'ItemFetch', fetch)
+    monkeypatch.setattr(morss, 'THREADS', 4)
+    monkeypatch.setattr(morss, 'MAX_ITEM', -1)
+    monkeypatch.setattr(morss, 'LIM_ITEM', -1)
+    monkeypatch.setattr(morss, 'LIM_TIME', -1)
+
+    return calls
+
+
+def test_parallel_fill_order(fake_fetch, monkeypatch):
+    monkeypatch.setattr(morss, 'MAX_TIME', -1)
+    links = ['http://a.test/0.3', 'http://b.test/0.1', 'http://c.test/0.2']
+
+    start = time.time()
+    rss = FeedGather(make_feed(links), 'http://test/', Options())
+
+    assert time.time() - start < 0.5
+    assert [item.content for item in rss.items] == ['fetched ' + x for x in links]
+
+
+def test_parallel_fill_late_items_from_cache(fake_fetch, monkeypatch):
+    monkeypatch.setattr(morss, 'MAX_TIME', 1)
+    links = ['http://a.test/0', 'http://b.test/3']
+
+    rss = FeedGather(make_feed(links), 'http://test/', Options())
+
+    assert rss.items[0].content == 'fetched http://a.test/0'
+    assert rss.items[1].content == 'cached http://b.test/3'
+
+
+def test_host_queue():
+    from concurrent import futures
+
+    pool = futures.ThreadPoolExecutor(max_workers=2)
+    queue = HostQueue(pool, 1)
+    running = []
+
+    def job(name, delay):
+        running.append(name)
+        assert running.count('a') <= 1
+        time.sleep(delay)
+        running.remove(name)
+        return name
+
+    slow = [queue.submit('a.test', job, 'a', 0.2) for i in range(3)]
+    fast = queue.submit('b.test', job, 'b', 0)
+
+    # not stuck behind the jobs waiting for a.test
+    assert fast.result(timeout=0.1) == 'b'
+    assert [x.result() for x in slow] == ['a'] * 3
+
+    pool.shutdown()
+
+
+def test_async_fill(monkeypatch):
+    async def fetch(link, options, fast=False, cache=None):
+        await asyncio.sleep(float(link.rsplit('/', 1)[-1]))
+        return {'content': 'fetched ' + link, 'main_image': None, 'url': link}
+
+    monkeypatch.setattr(morss, 'ItemFetchAsync', fetch)
+    monkeypatch.setattr(morss, 'MAX_ITEM', -1)
+    monkeypatch.setattr(morss, 'MAX_TIME', -1)
+    links = ['http://a.test/0.3', 'http://a.test/0.1', 'http://b.test/0.2']
+
+    start = time.time()
+    rss = asyncio.run(FeedGatherAsync(make_feed(links), 'http://test/', Options()))
+
+    assert time.time() - start < 0.5
+    assert [item.content for item in rss.items] == ['fetched ' + x for x in links]
+
+
+def test_extract_cache(monkeypatch):
+    calls = []
+
+    def extract(data, url=None, encoding_in=None, xpath=None):
+        calls.append(url)
+        return {'content': '<p>content</p>', 'main_image': None, 'images': []}
+
+    monkeypatch.setattr(readabilite, '_get_article_data', extract)
+
+    cache = CappedDict()
+    req = {'url': 'http://a.test/', 'data': b'<html>page</html>', 'encoding': 'utf-8', 'contenttype': 'text/html'}
+
+    assert ItemExtract(req, Options(), cache)['content'] == '<p>content</p>'
+    assert ItemExtract(req, Options(), cache)['content'] == '<p>content</p>'
+    assert len(calls) == 1
+
+    ItemExtract(dict(req, data=b'<html>new page</html>'), Options(), cache)
+    ItemExtract(req, Options(xpath='//p'), cache)
+    assert len(calls) == 3
+
+
+def test_known_bad_links(monkeypatch):
+    calls = []
+
+    def adv_get(url, policy=None, **kwargs):
+        calls.append((url, policy))
+        raise IOError('timed out')
+
+    monkeypatch.setattr(morss.crawler, 'adv_get', adv_get)
+    monkeypatch.setattr(morss, 'failures', CappedDict())
+    monkeypatch.setattr(morss, 'MAX_ITEM', -1)
+    monkeypatch.setattr(morss, 'MAX_TIME', -1)
+    monkeypatch.setattr(morss, 'LIM_TIME', -1)
+    links = ['http://a.test/1', 'http://a.test/2', 'http://a.test/3', 'http://a.test/4']
+
+    rss = FeedGather(make_feed(links[:1]), 'http://test/', Options())
+    assert len(rss.items) == 1
+
+    rss = FeedGather(make_feed(links[:1]), 'http://test/', Options())
+    assert calls == [(links[0], None), (links[0], 'offline')]
+    assert [item.title for item in rss.items] == links[:1] # kept, albeit not filled
+    assert not rss.complete
+
+    # the whole website, after a few failures
+    FeedGather(make_feed(links[1:3]), 'http://test/', Options())
+    rss = FeedGather(make_feed(links[3:]), 'http://test/', Options())
+    assert calls[-1] == (links[3], 'offline')
+    assert [item.title for item in rss.items] == links[3:]
+    assert not rss.complete
+
+    # not the feed itself though
+    assert morss.is_known_bad('http://a.test/feed.xml')
+    assert not morss.is_known_bad('http://a.test/feed.xml', host=False)
+
+
+def test_known_bad_host_errors(monkeypatch):
+    def adv_get(url, policy=None, **kwargs):
+        raise HTTPError(url, int(url.rsplit('/', 1)[-1]), 'error', {}, None)
+
+    monkeypatch.setattr(morss.crawler, 'adv_get', adv_get)
+    monkeypatch.setattr(morss, 'failures', CappedDict())
+
+    # missing pages don't say anything about the website
+    for i in range(5):
+        morss.ItemFetch('http://a.test/404', Options())
+
+    assert morss.is_known_bad('http://a.test/404')
+    assert not morss.is_known_bad('http://a.test/other')
+
+    for i in range(3):
+        morss.ItemFetch('http://b.test/503', Options())
+
+    assert morss.is_known_bad('http://b.test/other')
+
+
+def test_failure_backoff(monkeypatch):
+    monkeypatch.setattr(morss, 'failures', CappedDict())
+    monkeypatch.setattr(morss, 'FAIL_DELAY', 1)
+
+    url = 'http://a.test/1'
+
+    morss.record_failure(url)
+    count, until = morss.failures['url:' + url]
+    assert count == 1
+    assert until - time.time() == pytest.approx(1, abs=0.1)
+
+    time.sleep(1.1)
+    assert not morss.is_known_bad(url)
+
+    # retried after the delay, failed again: twice as long
+    morss.record_failure(url)
+    count, until = morss.failures['url:' + url]
+    assert count == 2
+    assert until - time.time() == pytest.approx(2, abs=0.1)
+    assert morss.is_known_bad(url)
+
+    morss.record_success(url)
+    assert not morss.is_known_bad(url)
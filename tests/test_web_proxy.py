@@ -1,6 +1,7 @@
 import pytest
 
-from morss.morss import Options, web_proxy_join
+from morss.morss import Options
+from morss.webproxy import web_proxy_join
 
 
 class MockItem:
@@ -173,7 +174,7 @@ def test_itemfix_with_absolute_link_from_external_domain_pattern2():
 
 def test_convert_absolute_url_to_proxy_pattern1():
     """Test convert_absolute_url_to_proxy with pattern 1 (embedded ://)"""
-    from morss.morss import convert_absolute_url_to_proxy
+    from morss.webproxy import convert_absolute_url_to_proxy
     
     web_proxy = "https://proxy.com/view/http://target.com"
     absolute_url = "https://example.com/page"
@@ -185,7 +186,7 @@ def test_convert_absolute_url_to_proxy_pattern1():
 
 def test_convert_absolute_url_to_proxy_pattern2():
     """Test convert_absolute_url_to_proxy with pattern 2 (protocol/domain)"""
-    from morss.morss import convert_absolute_url_to_proxy
+    from morss.webproxy import convert_absolute_url_to_proxy
     
     web_proxy = "https://proxy.saha.qzz.io/https/www.target.com"
     absolute_url = "https://external.com/page/123"
@@ -197,7 +198,7 @@ def test_convert_absolute_url_to_proxy_pattern2():
 
 def test_convert_absolute_url_to_proxy_pattern2_with_path():
     """Test convert_absolute_url_to_proxy with pattern 2 and arbitrary path in proxy"""
-    from morss.morss import convert_absolute_url_to_proxy
+    from morss.webproxy import convert_absolute_url_to_proxy
     
     web_proxy = "https://sitedl.westpan.me/123/https/t66y.com"
     absolute_url = "https://cdn.example.com/image.jpg"
@@ -0,0 +1,32 @@
+from morss.wsgi import cgi_app
+
+
+def call(path, **environ):
+    status = []
+
+    def start_response(code, headers, exc_info=None):
+        status.append((code, dict(headers)))
+
+    environ.update({'PATH_INFO': path, 'QUERY_STRING': ''})
+    out = b''.join(x if isinstance(x, bytes) else x.encode('utf-8') for x in cgi_app(environ, start_response))
+
+    return status[0][0], status[0][1], out
+
+
+def test_output_cache(replay_server):
+    path = '/:proxy/localhost:8888/feed-rss-channel-utf-8.txt'
+
+    code, headers, out = call(path)
+    assert code == '200 OK'
+    assert 'etag' in headers
+
+    code, headers2, out2 = call(path)
+    assert out2 == out
+    assert headers2['etag'] == headers['etag']
+
+    code, headers, out = call(path, HTTP_IF_NONE_MATCH=headers['etag'])
+    assert code == '304 Not Modified'
+    assert out == b''
+
+    code, headers, out = call('/:proxy:format=json/localhost:8888/feed-rss-channel-utf-8.txt', HTTP_IF_NONE_MATCH=headers2['etag'])
+    assert code == '200 OK'